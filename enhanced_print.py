@@ -25,9 +25,135 @@ def tree(obj, name='root', **kwargs):
     :param expand: if False, print out the object in one line, default=True
     :param return_instead: if True, no printing, but return a string instead, default=False
     :param show_type: if True, object type info will be added at the end of expanding object name, default=False
+    :param file: a writable file-like object to print to, default=sys.stdout
+    :param buffer_size: output is written to file in chunks of about buffer_size characters, default=65536
+    :param max_depth: if not None, items nested deeper than max_depth levels are replaced by a '… N more' marker, default=None
+    :param max_items: if not None, only the first max_items items of each object are shown, followed by a '… N more' marker, default=None
+    :param max_output_chars: if not None, the output stops with a '…' marker after max_output_chars characters, default=None
+    :param expand_shared_once: if True, an object referenced from several places is only expanded the first time, and shown as a '<ref to path>' afterwards; an object containing itself is always shown as a '<ref to path>', immutable containers like tuples are never shown as references, default=False
     :return:
         unicode (in PY2) or str (in PY3) or None (return_instead=False)
     """
+    if kwargs.get('return_instead', False):
+        return u''.join(_fragments(obj, name, **kwargs))
+    file = kwargs.get('file') or sys.stdout
+    buffer_size = kwargs.get('buffer_size', 65536)
+    chunk = []
+    length = 0
+    for fragment in _fragments(obj, name, **kwargs):
+        chunk.append(fragment)
+        length += len(fragment)
+        if length >= buffer_size:
+            six.print_(u''.join(chunk), end='', file=file)
+            chunk = []
+            length = 0
+    if chunk:
+        six.print_(u''.join(chunk), end='', file=file)
+
+
+def tree_lines(obj, name='root', **kwargs):
+    """
+    yield the lines of an object printed as a tree one by one, without line endings
+
+    :param obj: the object to be printed
+    :param name: the name of the object, default='root'
+    :param kwargs: the same as tree
+    :return:
+        a generator of unicode (in PY2) or str (in PY3)
+    """
+    line = []
+    for fragment in _fragments(obj, name, **kwargs):
+        if u'\n' in fragment:
+            parts = fragment.split(u'\n')
+            line.append(parts[0])
+            yield u''.join(line)
+            for part in parts[1:-1]:
+                yield part
+            line = [parts[-1]]
+        else:
+            line.append(fragment)
+    if u''.join(line):
+        yield u''.join(line)
+
+
+def _fragments(obj, name, **kwargs):
+    fragments = _tree(obj, name, **kwargs)
+    max_output_chars = kwargs.get('max_output_chars')
+    return fragments if max_output_chars is None else _truncate(fragments, max_output_chars)
+
+
+def _truncate(fragments, max_chars):
+    # stop pulling fragments once max_chars is reached, so the rest of the object is never visited
+    length = 0
+    for fragment in fragments:
+        if length + len(fragment) > max_chars:
+            yield fragment[:max_chars - length] + u'…\n'
+            return
+        length += len(fragment)
+        yield fragment
+
+
+def _more(n):
+    return u'… {} more'.format(n) if n is not None else u'… more'
+
+
+def _item_format(obj):
+    return None if isinstance(obj, dict) \
+        else "{{{}}}" if isinstance(obj, set) \
+        else "[{}]" if isinstance(obj, list) \
+        else "({})" if isinstance(obj, tuple) \
+        else "<{}>"
+
+
+def _path(frame):
+    # the path is only built when a reference is shown, rendering does not pay for it
+    parts = []
+    while frame.parent is not None:
+        parent = frame.parent
+        parts.append(u'.{}'.format(frame.name) if isinstance(parent.obj, dict)
+                     else parent.item_format.format(frame.position))
+        frame = parent
+    parts.append(u'{}'.format(frame.name))
+    return u''.join(reversed(parts))
+
+
+_immutable_types = (tuple, frozenset, six.binary_type, six.moves.range)
+_end = object()
+_unknown = object()
+
+
+class _Frame(object):
+    # one container that is being rendered, kept on an explicit stack instead of the call stack
+    # the next item is fetched one step ahead, so the last item is known without len(obj)
+    __slots__ = ('obj', 'parent', 'name', 'position', 'items', 'pending', 'index', 'limit', 'inline', 'item_format',
+                 'padding_base', 'body_end')
+
+    def __init__(self, obj, parent, name, limit, inline, item_format, padding_base, body_end):
+        self.obj = obj
+        self.parent = parent
+        self.name = name
+        self.position = parent.index if parent is not None else None
+        self.items = iter(obj) if limit != 0 else None
+        self.index = -1
+        self.limit = limit
+        self.inline = inline
+        self.item_format = item_format
+        self.padding_base = padding_base
+        self.body_end = body_end
+        self.fetch()
+
+    def fetch(self):
+        if self.limit is not None and self.index + 1 >= self.limit:
+            # nothing more is shown, so nothing more is fetched: the marker relies on len(obj) where there is one
+            n_items = len(self.obj) if hasattr(self.obj, '__len__') else None
+            self.pending = _end if n_items is not None and n_items <= self.index + 1 else _unknown
+        else:
+            self.pending = next(self.items, _end)
+
+
+def _tree(obj, name, **kwargs):
+    # a generator of output fragments, consumed by tree and tree_lines
+    # nesting is tracked with an explicit stack of frames, so the depth of obj is not limited by the recursion limit
     _kwargs = {'symbol_child_birth': ' ├─ ',
                'symbol_child_alive': ' │  ',
                'symbol_last_child_birth': ' └─ ',
@@ -40,94 +166,115 @@ def tree(obj, name='root', **kwargs):
                'padding_base': '',
                'padding_extra': '',
                'padding_increment': '',
-               'padding_end': '\n'}
+               'padding_end': '\n',
+               'max_depth': None,
+               'max_items': None,
+               'expand_shared_once': False}
     _kwargs.update(kwargs)
-    at_top_level_of_non_expand_line = False
-    if _kwargs['expand']:
-        _kwargs['expand'] = hasattr(obj, '__iter__') and not isinstance(obj, six.string_types)
-        if _kwargs['expand_types']:
-            _kwargs['expand'] = _kwargs['expand'] and isinstance(obj, tuple(_kwargs['expand_types']))
-        elif _kwargs['no_expand_types']:
-            _kwargs['expand'] = _kwargs['expand'] and not isinstance(obj, tuple(_kwargs['no_expand_types']))
-        if not _kwargs['expand']:
-            at_top_level_of_non_expand_line = True
-    result = u''
-    if _kwargs['expand']:
-        obj_type = ' ' + repr(type(obj)) if _kwargs['show_type'] else ''
-        head = u'{}{}{}{}\n'.format(_kwargs['padding_base'], _kwargs['padding_extra'], name, obj_type)
-        if _kwargs['return_instead']:
-            result += head
+    symbol_child_birth = _kwargs['symbol_child_birth']
+    symbol_child_alive = _kwargs['symbol_child_alive']
+    symbol_last_child_birth = _kwargs['symbol_last_child_birth']
+    symbol_last_child_alive = _kwargs['symbol_last_child_alive']
+    expand_types = tuple(_kwargs['expand_types'])
+    no_expand_types = tuple(_kwargs['no_expand_types'])
+    show_type = _kwargs['show_type']
+    expanded_padding_end = _kwargs['padding_end']
+    max_depth = _kwargs['max_depth']
+    max_items = _kwargs['max_items']
+    expand_shared_once = _kwargs['expand_shared_once']
+    # id -> frame of the objects being rendered, or of all rendered objects if expand_shared_once
+    # the frame keeps its obj alive, so that the id is not reused while rendering
+    frames = {}
+    # the state of the node about to be rendered
+    expand = _kwargs['expand']
+    padding_base = _kwargs['padding_base']
+    padding_extra = _kwargs['padding_extra']
+    padding_increment = _kwargs['padding_increment']
+    padding_end = expanded_padding_end
+    stack = []
+    while True:
+        iterable = hasattr(obj, '__iter__') and not isinstance(obj, six.string_types)
+        limit = 0 if max_depth is not None and len(stack) >= max_depth else max_items
+        # immutable containers cannot close a cycle, and equal constants may be one shared object
+        tracked = iterable and not isinstance(obj, _immutable_types)
+        reference = frames.get(id(obj)) if tracked else None
+        if reference is not None:
+            expand = iterable = False
+        parent = stack[-1] if stack else None
+        at_top_level_of_non_expand_line = False
+        if expand:
+            expand = iterable
+            if expand_types:
+                expand = expand and isinstance(obj, expand_types)
+            elif no_expand_types:
+                expand = expand and not isinstance(obj, no_expand_types)
+            if not expand:
+                at_top_level_of_non_expand_line = True
+        if expand:
+            obj_type = ' ' + repr(type(obj)) if show_type else ''
+            yield u'{}{}{}{}\n'.format(padding_base, padding_extra, name, obj_type)
+            frame = _Frame(obj, parent, name, limit, False, _item_format(obj), padding_base + padding_increment, None)
+            if tracked:
+                frames[id(obj)] = frame
+            stack.append(frame)
         else:
-            six.print_(head, end='')
-        _kwargs['padding_base'] = _kwargs['padding_base'] + _kwargs['padding_increment']
-        for i, item in enumerate(obj):
-            if isinstance(obj, dict):
-                item, item_name = obj[item], item
+            yield u'{}{}{}{}'.format(padding_base, padding_extra, name, ': ' if name else '')
+            if iterable:
+                yield u'{' if isinstance(obj, (dict, set)) \
+                    else u'[' if isinstance(obj, list) \
+                    else u'(' if isinstance(obj, tuple) \
+                    else u'<'
+                body_end = u'}' if isinstance(obj, (dict, set)) \
+                    else u']' if isinstance(obj, list) \
+                    else u')' if isinstance(obj, tuple) \
+                    else u'>'
+                body_end += "\n" if at_top_level_of_non_expand_line else ""
+                frame = _Frame(obj, parent, name, limit, True, _item_format(obj), None, body_end)
+                if tracked:
+                    frames[id(obj)] = frame
+                stack.append(frame)
+            elif reference is not None:
+                yield u'<ref to {}>{}'.format(_path(reference), padding_end)
             else:
-                item_name = "{{{}}}".format(i) if isinstance(obj, set) \
-                    else "[{}]".format(i) if isinstance(obj, list) \
-                    else "({})".format(i) if isinstance(obj, tuple) \
-                    else "<{}>".format(i)
-            if i < len(obj) - 1:
-                _kwargs['padding_extra'] = _kwargs['symbol_child_birth']
-                _kwargs['padding_increment'] = _kwargs['symbol_child_alive']
+                yield (obj if isinstance(obj, six.string_types) else repr(obj)) + padding_end
+        # pop finished frames until one of them has a next item to render
+        while stack:
+            frame = stack[-1]
+            if frame.inline and frame.index >= 0 and frame.pending is not _end:
+                yield ', '
+            item = frame.pending
+            if item is not _end and frame.limit is not None and frame.index + 1 >= frame.limit:
+                # stop here without fetching the remaining items
+                n = len(frame.obj) - frame.index - 1 if hasattr(frame.obj, '__len__') else None
+                if frame.inline:
+                    yield _more(n)
+                else:
+                    yield u'{}{}{}{}'.format(frame.padding_base, symbol_last_child_birth, _more(n), expanded_padding_end)
+                item = _end
+            if item is _end:
+                stack.pop()
+                if not expand_shared_once:
+                    frames.pop(id(frame.obj), None)
+                if frame.inline:
+                    yield frame.body_end
+                continue
+            frame.index += 1
+            frame.fetch()
+            if isinstance(frame.obj, dict):
+                obj, name = frame.obj[item], item
             else:
-                _kwargs['padding_extra'] = _kwargs['symbol_last_child_birth']
-                _kwargs['padding_increment'] = _kwargs['symbol_last_child_alive']
-            if _kwargs['return_instead']:
-                result += tree(item, item_name, **_kwargs)
+                obj, name = item, "" if frame.inline else frame.item_format.format(frame.index)
+            if frame.inline:
+                expand = False
+                padding_base = padding_extra = padding_increment = padding_end = ""
             else:
-                tree(item, item_name, **_kwargs)
-    else:
-        head = u'{}{}{}{}'.format(_kwargs['padding_base'], _kwargs['padding_extra'], name, ': ' if name else '')
-        if _kwargs['return_instead']:
-            result += head
-        else:
-            six.print_(head, end='')
-        if hasattr(obj, '__iter__') and not isinstance(obj, six.string_types):
-            body_start = u'{' if isinstance(obj, (dict, set)) \
-                else u'[' if isinstance(obj, list) \
-                else u'(' if isinstance(obj, tuple) \
-                else u'<'
-            if _kwargs['return_instead']:
-                result += body_start
-            else:
-                six.print_(body_start, end='')
-            _kwargs['padding_base'] = ""
-            _kwargs['padding_extra'] = ""
-            _kwargs['padding_increment'] = ""
-            _kwargs['padding_end'] = ""
-            for i, item in enumerate(obj):
-                if isinstance(obj, dict):
-                    item, item_name = obj[item], item
-                else:
-                    item_name = ""
-                if _kwargs['return_instead']:
-                    result += tree(item, item_name, **_kwargs)
+                expand = True
+                padding_base = frame.padding_base
+                padding_end = expanded_padding_end
+                if frame.pending is not _end:
+                    padding_extra, padding_increment = symbol_child_birth, symbol_child_alive
                 else:
-                    tree(item, item_name, **_kwargs)
-                if i < len(obj) - 1:
-                    sep = ', '
-                else:
-                    sep = ''
-                if _kwargs['return_instead']:
-                    result += sep
-                else:
-                    six.print_(sep, end='')
-            body_end = u'}' if isinstance(obj, (dict, set)) \
-                else u']' if isinstance(obj, list) \
-                else u')' if isinstance(obj, tuple) \
-                else u'>'
-            body_end += "\n" if at_top_level_of_non_expand_line else ""
-            if _kwargs['return_instead']:
-                result += body_end
-            else:
-                six.print_(body_end, end='')
+                    padding_extra, padding_increment = symbol_last_child_birth, symbol_last_child_alive
+            break
         else:
-            body = (obj if isinstance(obj, six.string_types) else repr(obj)) + _kwargs['padding_end']
-            if _kwargs['return_instead']:
-                result += body
-            else:
-                six.print_(body, end='')
-    if _kwargs['return_instead']:
-        return result
+            return
@@ -0,0 +1,223 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import metric_generator as mg
+
+
+def deep_expression(depth):
+    m = mg.Sin(1440, 10) + mg.Normal(seed=0)
+    for i in range(depth):
+        m = +(m * 1 + (i % 3) * mg.Cos(60 + i)) - mg.Const(2) * mg.Const(0.5)
+    return m
+
+
+def wide_expression(width):
+    terms = [mg.Sin(60 + i, i % 7) * mg.Rand(seed=i) for i in range(width)]
+    # pairwise, so the tree is wide rather than deep
+    while len(terms) > 1:
+        terms = [terms[i] + terms[i + 1] if i + 1 < len(terms) else terms[i] for i in range(0, len(terms), 2)]
+    return terms[0]
+
+
+node_cases = {
+    'Const': lambda: mg.Const(1.5),
+    'Fragment': lambda: mg.Fragment(np.arange(1000.)),
+    'Normal': lambda: mg.Normal(seed=0),
+    'Rand': lambda: mg.Rand(seed=0),
+    'RandInt': lambda: mg.RandInt(0, 10, seed=0),
+    'RandChoice': lambda: mg.RandChoice([1, 2, 3], [.2, .3, .5], seed=0),
+    'Sin': lambda: mg.Sin(1440),
+    'Cos': lambda: mg.Cos(1440),
+    'Abs': lambda: mg.Abs(mg.Sin(60)),
+    'Acc': lambda: mg.Acc(mg.Sin(60)),
+    'Diff': lambda: mg.Diff(mg.Sin(60)),
+    'Shift': lambda: mg.Shift(mg.Sin(60), 10),
+    'Smooth': lambda: mg.Smooth(mg.Sin(60), 60),
+    'Regress': lambda: mg.Regress(mg.Sin(60), [.5, .3, .2]),
+    'AutoRegress': lambda: mg.AutoRegress(mg.Sin(60), [.5, .3, .2]),
+    'Downsample': lambda: mg.Downsample(mg.Sin(60), 10),
+    'Repeat': lambda: mg.Repeat(mg.Sin(60), 100, 1100),
+    'Cycle': lambda: mg.Cycle(mg.Sin(60), 100, 1100),
+    'Concat': lambda: mg.Concat(mg.Sin(60), mg.Cos(60), at=1000),
+    'Lines': lambda: mg.Lines([(i * 60, (i * 37) % 11) for i in range(500)]),
+    'Steps': lambda: mg.Steps([(i * 60, (i * 37) % 11) for i in range(500)]),
+    'Add': lambda: mg.Sin(60) + mg.Cos(60),
+    'Sub': lambda: mg.Sin(60) - mg.Cos(60),
+    'Mul': lambda: mg.Sin(60) * mg.Cos(60),
+    'Div': lambda: mg.Sin(60) / (mg.Cos(60) + 2),
+    'Mod': lambda: mg.Sin(60) % 0.3,
+    'Pow': lambda: mg.Abs(mg.Sin(60)) ** 1.5,
+    'Pulse': lambda: mg.Pulse(list(range(0, 10 ** 7, 7)), 1),
+    'Min': lambda: mg.Min(mg.Sin(60), mg.Cos(60)),
+    'Max': lambda: mg.Max(mg.Sin(60), mg.Cos(60)),
+}
+
+parse_cases = {
+    'simple': 'sin(60) + normal(seed=1)',
+    'nested': 'smooth(abs(sin(1440, 10) + normal(seed=1)), 60) * rand_int(1, 3, seed=2) + #[1, 2, 3]',
+    'variables': '$a * 2 + $b.shift(5) - $a',
+}
+
+
+def timeit(build, run, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        m = build()
+        start = time.perf_counter()
+        run(m)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(build, run):
+    m = build()
+    tracemalloc.start()
+    try:
+        run(m)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(build, n, scalar_n=None):
+    scalar_n = n if scalar_n is None else scalar_n
+    return {'scalar': scalar_n / timeit(build, lambda m: m.next(scalar_n)),
+            'block': n / timeit(build, lambda m: m.next_block(n)),
+            'peak_bytes': peak_memory(build, lambda m: m.next_block(n))}
+
+
+def bench_nodes(n=100000, scalar_n=10000):
+    return {name: measure(build, n, scalar_n) for name, build in node_cases.items()}
+
+
+def bench_shapes(depth=50, width=200, n=20000):
+    return {f'deep_{depth}': measure(lambda: deep_expression(depth), n),
+            f'deep_{depth}_compiled': measure(lambda: deep_expression(depth).compile(), n),
+            f'wide_{width}': measure(lambda: wide_expression(width), n)}
+
+
+def tree_memory(build):
+    tracemalloc.start()
+    try:
+        metrics = build()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    n_nodes = sum(len(list(m.walk())) for m in metrics)
+    return {'nodes': n_nodes, 'bytes': size, 'bytes_per_node': size / n_nodes}
+
+
+def bench_tree_memory(n_nodes=10000):
+    # one large tree, and many small per-tenant trees of the same total size
+    return {f'wide_{n_nodes}': tree_memory(lambda: [wide_expression(n_nodes // 4)]),
+            f'tenants_{n_nodes}': tree_memory(lambda: [mg.Smooth(mg.Sin(60 + i) + mg.Rand(seed=i), 10).shift(3) * 2
+                                                       for i in range(n_nodes // 7)]),
+            'fragment_100000': tree_memory(lambda: [mg.Fragment(list(range(100000)))])}
+
+
+def bench_parse(repeat=100):
+    results = {}
+    for name, expr in parse_cases.items():
+        metrics = {'a': mg.Sin(60), 'b': mg.Cos(60)} if '$' in expr else {}
+        start = time.perf_counter()
+        for _ in range(repeat):
+            mg.compile_expr.cache_clear()
+            mg.parse(expr, **metrics)
+        cold = (time.perf_counter() - start) / repeat
+        start = time.perf_counter()
+        for _ in range(repeat):
+            mg.parse(expr, **metrics)
+        warm = (time.perf_counter() - start) / repeat
+        results[name] = {'cold_seconds': cold, 'warm_seconds': warm}
+    return results
+
+
+def bench_periodic(period=100000, n=1000000):
+    # long periods, several laps
+    return {f'{cls.__name__}_{period}': measure(lambda: cls(mg.Sin(60) + mg.Normal(seed=0), 1000, 1000 + period), n,
+                                                n // 10)
+            for cls in (mg.Repeat, mg.Cycle)}
+
+
+def bench_compile(depth=50, n=20000):
+    results = []
+    for label, build in (('interpreted', lambda: deep_expression(depth)),
+                         ('compiled', lambda: deep_expression(depth).compile())):
+        scalar = timeit(build, lambda m: m.next(n))
+        block = timeit(build, lambda m: m.next_block(n))
+        results.append((label, n / scalar, n / block))
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def flatten(results, prefix=''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f'{prefix}{key}.')
+        else:
+            yield f'{prefix}{key}', value
+
+
+def compare(old, new):
+    old = dict(flatten(old['results']))
+    for key, value in flatten(new['results']):
+        if key in old and old[key]:
+            # throughput is better when higher, memory and latency when lower, node counts are neither
+            ratio = value / old[key]
+            verdict = '' if key.endswith('.nodes') \
+                else '+' if (ratio > 1 if key.endswith(('scalar', 'block')) else ratio < 1) else '-'
+            print(f'{key:<48} {old[key]:>16,.6g} {value:>16,.6g} {ratio:>8.2f}x {verdict}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark metric_generator')
+    parser.add_argument('--depth', type=int, default=50)
+    parser.add_argument('--width', type=int, default=200)
+    parser.add_argument('-n', type=int, default=20000)
+    parser.add_argument('--suite', action='store_true', help='run the full suite instead of the compile benchmark')
+    parser.add_argument('-o', '--output', help='write suite results as json')
+    parser.add_argument('--compare', help='compare suite results with a previous json file')
+    args = parser.parse_args()
+    if not args.suite:
+        print(f'deep expression, depth={args.depth}, n={args.n}')
+        for label, scalar, block in bench_compile(args.depth, args.n):
+            print(f'{label:>12}: {scalar:>14,.0f} samples/s scalar, {block:>14,.0f} samples/s block')
+        return
+    np.random.seed(0)
+    results = {'environment': environment(),
+               'results': {'nodes': bench_nodes(),
+                           'shapes': bench_shapes(args.depth, args.width, args.n),
+                           'memory': bench_tree_memory(),
+                           'parse': bench_parse(),
+                           'periodic': bench_periodic()}}
+    for key, value in flatten(results['results']):
+        print(f'{key:<48} {value:>16,.6g}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            print(f'\ncompared with {args.compare}')
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
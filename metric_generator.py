@@ -1,17 +1,54 @@
 from abc import ABC, abstractmethod
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from multiprocessing import shared_memory
+import ast
+import asyncio
+import base64
+import copy
+import heapq
+import inspect
+import json
+import math
+import os
+import pickle
 import re
+import struct
+import time
+import tracemalloc
+import weakref
 
 import numpy as np
 
 _abs = abs
 _min = min
 _max = max
+_chunk_size = 65536
+_metric_prefix = '_metric_'
+_valid_nodes = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Call,
+    ast.keyword,
+    ast.Attribute,
+    ast.Subscript,
+    ast.Name,
+    ast.Constant,
+    ast.List,
+    ast.Tuple,
+    ast.Dict,
+    ast.expr_context,
+    ast.operator,
+    ast.unaryop
+)
 _valid_names = {
     '_x2m',
     'abs',
     'acc',
     'amplitude',
+    'astype',
     'at',
     'autoregress',
     'avg',
@@ -23,9 +60,11 @@ _valid_names = {
     'cycle',
     'diff',
     'downsample',
+    'dtype',
     'end',
     'factors',
     'frag',
+    'initial',
     'initial_phase',
     'left',
     'lines',
@@ -53,10 +92,12 @@ _valid_names = {
     'right',
     'sample_size',
     'scale',
+    'seed',
     'shift',
     'sin',
     'smooth',
     'start',
+    'steps',
     'up',
     'val',
     'value',
@@ -71,6 +112,80 @@ def _show_iterable_with_length_limit(obj, n):
      return f'[{", ".join(map(str, obj[:n]))}{f", ..." if len(obj) > n else ""}]'
 
 
+def _push(metric, value):
+    metric.window_values[metric.pos] = value
+    metric.window_values[metric.pos + metric.window_size] = value
+    metric.pos = (metric.pos + 1) % metric.window_size
+
+
+def _fill(metric, values):
+    metric.window_values[:metric.window_size] = values
+    metric.window_values[metric.window_size:] = values
+    metric.pos = 0
+
+
+def _div(v1, v2, floor=False):
+    if np.isnan(v2):
+        return np.nan
+    elif v2 == 0:
+        return np.inf
+    else:
+        return v1 // v2 if floor else v1 / v2
+
+
+def _div_block(v1, v2, floor=False):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = v1 // v2 if floor else v1 / v2
+    return np.where(np.isnan(v2), np.nan, np.where(v2 == 0, np.inf, values))
+
+
+def _mod(v1, v2):
+    if np.isnan(v2):
+        return np.nan
+    elif v2 == 0:
+        return v1
+    else:
+        return v1 % v2
+
+
+def _mod_block(v1, v2):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = v1 % v2
+    return np.where(np.isnan(v2), np.nan, np.where(v2 == 0, v1, values))
+
+
+def _pow_block(v1, v2):
+    v1 = np.asarray(v1)
+    v2 = np.asarray(v2)
+    if v1.dtype.kind in 'iu' and v2.dtype.kind in 'iu' and (v2 < 0).any():
+        v1 = v1.astype(float)
+    return v1 ** v2
+
+
+def _copy_state(value):
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    elif isinstance(value, list):
+        return list(value)
+    return value
+
+
+def _freeze(value):
+    if isinstance(value, Metric):
+        return Metric, id(value)
+    elif isinstance(value, np.ndarray):
+        return np.ndarray, value.dtype.str, value.shape, value.tobytes()
+    elif isinstance(value, (list, tuple)):
+        return type(value), tuple(_freeze(v) for v in value)
+    elif isinstance(value, dict):
+        return dict, tuple((_freeze(k), _freeze(v)) for k, v in value.items())
+    try:
+        hash(value)
+    except TypeError:
+        return object, id(value)
+    return type(value), value
+
+
 def _x2m(x):
     if isinstance(x, Metric):
         return x
@@ -106,10 +221,26 @@ def max(*xs):
 
 
 class Metric(ABC):
+    __slots__ = ('_i', '_v', '__weakref__')
+    _state_attrs = ()
+    _seekable = False
+    _fields = ('_i', '_v')
+
     def __init__(self):
         self._i = -1
         self._v = None
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._fields = tuple(k for c in cls.__mro__ for k in c.__dict__.get('__slots__', ()) if k != '__weakref__')
+
+    def __getstate__(self):
+        return dict(self._items())
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
     def __iter__(self):
         return self
 
@@ -121,9 +252,8 @@ class Metric(ABC):
     def __getitem__(self, item):
         if item < 0:
             raise ValueError('does not support negative indexing')
-        if item < self._i:
-            raise ValueError('cannot go backward')
-        for i in range(item - self._i):
+        if item != self._i:
+            self.seek(item)
             self.__next__()
         return self._v
 
@@ -190,30 +320,145 @@ class Metric(ABC):
     @property
     def last(self):
         return self._v
+
+    @property
+    def seekable(self):
+        return self._seekable and all(node.seekable for node in self.children())
+
+    def seek(self, item):
+        if item < 0:
+            raise ValueError('does not support negative indexing')
+        if self.seekable:
+            self._jump(item)
+        else:
+            if item <= self._i:
+                self.reset()
+            self._skip(item - self._i - 1)
     
     def next(self, n=1):
         return [self.__next__() for _ in range(n)]
 
+    def next_block(self, n):
+        if n <= 0:
+            return np.empty(0)
+        values = self._calc_block(self._i + 1, n)
+        self._i += n
+        self._v = values[-1]
+        return values
+
+    def iter_chunks(self, chunk_size=_chunk_size, length=None):
+        remaining = math.inf if length is None else length
+        while remaining > 0:
+            n = _min(chunk_size, remaining)
+            yield self.next_block(n)
+            remaining -= n
+
+    def children(self):
+        for _, v in self._items():
+            if isinstance(v, Metric):
+                yield v
+            elif isinstance(v, list):
+                for vi in v:
+                    if isinstance(vi, Metric):
+                        yield vi
+
+    def walk(self):
+        visited = set()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+            yield node
+            stack.extend(reversed(list(node.children())))
+
+    def dedup(self):
+        # a copy is rewritten, the nodes of the caller keep their children and positions
+        return self._copy_tree()._dedup()
+
+    def _dedup(self):
+        # merge structurally identical subtrees, children before their parents
+        tree = self
+        canonical = {}
+        replaced = {}
+        # the nodes kept after merging, so the merged tree is not walked again
+        nodes = []
+        for node in tree._post_order():
+            node._map_children(lambda child: replaced[id(child)])
+            key = (type(node), tuple((k, _freeze(v)) for k, v in node._items()))
+            replaced[id(node)] = canonical.setdefault(key, node)
+            if replaced[id(node)] is node:
+                nodes.append(node)
+        root = replaced[id(tree)]
+        n_refs = {}
+        for node in nodes:
+            for child in node.children():
+                n_refs[id(child)] = n_refs.get(id(child), 0) + 1
+        shares = {}
+        kept = set()
+
+        def fan_out(child):
+            if n_refs[id(child)] < 2:
+                return child
+            elif _is_small_elementwise(child):
+                # small elementwise subtrees are cheaper to evaluate twice than to buffer
+                if id(child) in kept:
+                    return child._copy_tree()
+                kept.add(id(child))
+                return child
+            elif id(child) not in shares:
+                shares[id(child)] = Share(child)
+            # a tap takes over the position of the node it replaces, the share starts there too
+            tap = shares[id(child)].tap()
+            tap._i, tap._v = child._i, child._v
+            return tap
+
+        if _max(n_refs.values(), default=0) > 1:
+            for node in nodes:
+                node._map_children(fan_out)
+        return root
+
+    def compile(self):
+        return Compiled(self)
+
+    def profile(self, memory=False):
+        return Profiler(self, memory)
+
+    def dumps(self, state=False, binary=False):
+        return dumps(self, state=state, binary=binary)
+
+    def seed(self, seed=None):
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        nodes = [node for node in self.walk() if isinstance(node, _RandomMetric)]
+        for node, node_seed in zip(nodes, seed.spawn(len(nodes))):
+            node.set_seed(node_seed)
+        return self
+
     def reset(self):
         self._reset()
         self._i = -1
         self._v = None
 
+    def get_state(self):
+        return [node._get_state() for node in self.walk()]
+
+    def set_state(self, state):
+        nodes = list(self.walk())
+        if len(nodes) != len(state):
+            raise ValueError(f'state of {len(state)} nodes does not match a tree of {len(nodes)} nodes')
+        for node, node_state in zip(nodes, state):
+            node._set_state(node_state)
+
     def restore(self, from_obj):
-        for k, v in from_obj.__dict__.items():
-            if isinstance(v, Metric):
-                self.__dict__[k].restore(v)
-            elif isinstance(v, list):
-                for i, vi in enumerate(v):
-                    if isinstance(vi, Metric):
-                        self.__dict__[k][i].restore(vi)
-                    else:
-                        self.__dict__[k][i] = vi
-            else:
-                self.__dict__[k] = v
+        self.set_state(from_obj.get_state())
     
-    def acc(self):
-        return Acc(self)
+    def astype(self, dtype):
+        return Cast(self, dtype)
+
+    def acc(self, dtype=None):
+        return Acc(self, dtype=dtype)
 
     def diff(self):
         return Diff(self)
@@ -231,7 +476,7 @@ class Metric(ABC):
         return AutoRegress(self, factors)
 
     def downsample(self, sample_size, method='avg'):
-        return Downsample(self, sample_size, method=method)
+        return downsample(self, sample_size, method=method)
 
     def repeat(self, start, end, n=None):
         return Repeat(self, start, end, n=n)
@@ -258,12 +503,88 @@ class Metric(ABC):
     def _calc(self, item):
         pass
 
+    def _calc_block(self, item, n):
+        return np.array([self._calc(i) for i in range(item, item + n)])
+
+    def _post_order(self):
+        visited = set()
+        nodes = []
+        stack = [(self, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                nodes.append(node)
+            elif id(node) not in visited:
+                visited.add(id(node))
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(list(node.children())))
+        return nodes
+
+    def _copy_tree(self):
+        # copies own their state, and shares only know the taps of the copy
+        copies = {}
+        for node in self._post_order():
+            copies[id(node)] = copy.copy(node)
+            copies[id(node)]._map_children(lambda child: copies[id(child)])
+            for k in node._state_attrs:
+                setattr(copies[id(node)], k, _copy_state(getattr(node, k)))
+            if isinstance(node, Share):
+                copies[id(node)].taps = weakref.WeakSet()
+        for node in copies.values():
+            if isinstance(node, Tap):
+                node.share.taps.add(node)
+        return copies[id(self)]
+
+    def _items(self):
+        # slots from the most derived class down, then attributes of subclasses without slots
+        for k in self._fields:
+            if hasattr(self, k):
+                yield k, getattr(self, k)
+        yield from getattr(self, '__dict__', {}).items()
+
+    def _map_children(self, func):
+        for k, v in list(self._items()):
+            if isinstance(v, Metric):
+                setattr(self, k, func(v))
+            elif isinstance(v, list):
+                setattr(self, k, [func(vi) if isinstance(vi, Metric) else vi for vi in v])
+
+    def _skip(self, n):
+        # advance without materializing more than one chunk at a time
+        if n > 0 and self.seekable:
+            self._jump(self._i + 1 + n)
+        while n > 0 and not self.seekable:
+            self.next_block(_min(n, _chunk_size))
+            n -= _chunk_size
+
+    def _jump(self, item):
+        self._seek(item)
+        self._i = item - 1
+        self._v = None
+
+    def _seek(self, item):
+        for node in self.children():
+            node._jump(item)
+
+    def _get_state(self):
+        return (self._i, self._v) + tuple(_copy_state(getattr(self, k)) for k in self._state_attrs)
+
+    def _set_state(self, state):
+        if len(state) != len(self._state_attrs) + 2:
+            raise ValueError(f'invalid state for {type(self).__name__}')
+        self._i, self._v = state[:2]
+        for k, v in zip(self._state_attrs, state[2:]):
+            setattr(self, k, _copy_state(v))
+
     @abstractmethod
     def _reset(self):
         pass
 
 
 class Const(Metric):
+    __slots__ = ('value',)
+    _seekable = True
+
     def __init__(self, value):
         self.value = value
         super().__init__()
@@ -273,86 +594,175 @@ class Const(Metric):
     
     def _calc(self, item):
         return self.value
+
+    def _calc_block(self, item, n):
+        return np.full(n, self.value)
     
     def _reset(self):
         pass
 
 
 class Fragment(Metric):
-    def __init__(self, values):
-        self.values = values
-        self.len = len(values)
+    __slots__ = ('values', 'len')
+    _seekable = True
+
+    def __init__(self, values, dtype=None):
+        self.values = np.asarray(values, dtype=dtype)
+        self.len = len(self.values)
         super().__init__()
     
     def __repr__(self):
         return f'<Fragment({_show_iterable_with_length_limit(self.values, 4)}, len={self.len})>'
     
     def _calc(self, item):
-        return self.values[item] if item < self.len else 0
+        return self.values[item].item() if item < self.len else 0
+
+    def _calc_block(self, item, n):
+        values = self.values[item:item + n].copy()
+        if len(values) == n:
+            return values
+        return np.concatenate((values, np.zeros(n - len(values), dtype=values.dtype)))
     
     def _reset(self):
         pass
 
 
-class Normal(Metric):
-    def __init__(self, scale=1, loc=0):
+class _RandomMetric(Metric):
+    __slots__ = ('dtype', 'key', 'rng', 'batch', 'buffer')
+    _seekable = True
+    batch_size = 4096
+
+    def __init__(self, seed=None, dtype=None):
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.set_seed(seed)
+        super().__init__()
+
+    def __getstate__(self):
+        # the buffer is a cache, refilled from the key on demand
+        state = super().__getstate__()
+        for k in ('rng', 'batch', 'buffer'):
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.rng = None
+        self.batch = -1
+        self.buffer = None
+
+    def set_seed(self, seed=None):
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.key = seed.generate_state(2, np.uint64)
+        self.rng = None
+        self.batch = -1
+        self.buffer = None
+
+    def _fill(self, batch):
+        # every batch owns its own counter range, so a value only depends on the seed and its index
+        self.rng = np.random.Generator(np.random.Philox(key=self.key, counter=[0, batch, 0, 0]))
+        self.buffer = self._draw(self.batch_size)
+        self.batch = batch
+
+    def _calc(self, item):
+        batch, i = divmod(item, self.batch_size)
+        if batch != self.batch:
+            self._fill(batch)
+        # python scalars like Fragment, unless a dtype is asked for
+        return self.buffer[i] if self.dtype is not None else self.buffer[i].item()
+
+    def _calc_block(self, item, n):
+        values = []
+        end = item + n
+        while item < end:
+            batch, i = divmod(item, self.batch_size)
+            if batch != self.batch:
+                self._fill(batch)
+            values.append(self.buffer[i:i + end - item])
+            item += len(values[-1])
+        return np.concatenate(values)
+
+    def _get_state(self):
+        return super()._get_state() + (self.key.copy(),)
+
+    def _set_state(self, state):
+        super()._set_state(state[:-1])
+        if not np.array_equal(state[-1], self.key):
+            self.key = state[-1].copy()
+            self.rng = None
+            self.batch = -1
+            self.buffer = None
+
+    @abstractmethod
+    def _draw(self, size):
+        pass
+
+    def _reset(self):
+        pass
+
+
+class Normal(_RandomMetric):
+    __slots__ = ('scale', 'loc')
+
+    def __init__(self, scale=1, loc=0, seed=None, dtype=None):
         self.scale = scale
         self.loc = loc
-        super().__init__()
+        super().__init__(seed, dtype)
 
     def __repr__(self):
         return f'<Normal({self.scale}, loc={self.loc})>'
     
-    def _calc(self, item):
-        return np.random.normal(loc=self.loc, scale=self.scale)
-    
-    def _reset(self):
-        pass
+    def _draw(self, size):
+        if self.dtype is not None:
+            return (self.rng.standard_normal(size, dtype=self.dtype) * self.scale + self.loc).astype(self.dtype)
+        return self.rng.normal(loc=self.loc, scale=self.scale, size=size)
 
 
-class Rand(Metric):
-    def __init__(self, *args):
+class Rand(_RandomMetric):
+    __slots__ = ('low', 'high', 'range')
+
+    def __init__(self, *args, seed=None, dtype=None):
         if len(args) == 0:
             args = [0, 1]
         elif len(args) == 1:
             args = [0, args[0]]
         self.low = _min(args)
         self.high = _max(args)
-        self.range = high - low
-        super().__init__()
+        self.range = self.high - self.low
+        super().__init__(seed, dtype)
     
     def __repr__(self):
         return f'<Rand({self.low}, {self.high})>'
     
-    def _calc(self, item):
-        return self.low + np.random.random() * self.range
-    
-    def _reset(self):
-        pass
+    def _draw(self, size):
+        if self.dtype is not None:
+            return (self.low + self.rng.random(size, dtype=self.dtype) * self.range).astype(self.dtype)
+        return self.low + self.rng.random(size) * self.range
 
 
-class RandInt(Metric):
-    def __init__(self, *args):
+class RandInt(_RandomMetric):
+    __slots__ = ('low', 'high')
+
+    def __init__(self, *args, seed=None, dtype=None):
         if len(args) == 0:
             args = [0, 1]
         elif len(args) == 1:
             args = [0, args[0]]
         self.low = _min(args)
         self.high = _max(args)
-        super().__init__()
+        super().__init__(seed, dtype)
 
     def __repr__(self):
         return f'<RandInt({self.low}, {self.high})>'
     
-    def _calc(self, item):
-        return np.random.randint(self.low, self.high + 1)
-    
-    def _reset(self):
-        pass
+    def _draw(self, size):
+        return self.rng.integers(self.low, self.high, size=size, endpoint=True, dtype=self.dtype or np.int64)
 
 
-class RandChoice(Metric):
-    def __init__(self, choices, weights=None):
+class RandChoice(_RandomMetric):
+    __slots__ = ('choices', 'len', 'values', 'cdf', 'weights')
+
+    def __init__(self, choices, weights=None, seed=None, dtype=None):
         self.choices = choices
         self.len = len(choices)
         if weights is None:
@@ -362,7 +772,10 @@ class RandChoice(Metric):
         else:
             weight_sum = sum(weights)
             self.weights = [w / weight_sum for w in weights]
-        super().__init__()
+        self.values = np.asarray(choices, dtype=dtype)
+        self.cdf = np.cumsum(self.weights)
+        self.cdf[-1] = 1
+        super().__init__(seed, dtype)
     
     def __repr__(self):
         return (f'<RandChoice({_show_iterable_with_length_limit(self.choices, 4)}, '
@@ -370,14 +783,14 @@ class RandChoice(Metric):
                 f'weights={_show_iterable_with_length_limit(self.weights, 4)}'
                 ')>')
     
-    def _calc(self, item):
-        return np.random.choice(self.choices, p=self.weights)
-    
-    def _reset(self):
-        pass
+    def _draw(self, size):
+        return self.values[np.searchsorted(self.cdf, self.rng.random(size), side='right')]
 
 
 class Sin(Metric):
+    __slots__ = ('period', 'amplitude', 'initial_phase', 'phase')
+    _seekable = True
+
     def __init__(self, period, amplitude=1, initial_phase=0):
         self.period = period
         self.amplitude = amplitude
@@ -390,12 +803,19 @@ class Sin(Metric):
     
     def _calc(self, item):
         return self.amplitude * np.sin(item * (2 * np.pi) / self.period + self.initial_phase)
+
+    def _calc_block(self, item, n):
+        items = np.arange(item, item + n)
+        return self.amplitude * np.sin(items * (2 * np.pi) / self.period + self.initial_phase)
     
     def _reset(self):
         self.phase = self.initial_phase
 
 
 class Cos(Metric):
+    __slots__ = ('period', 'amplitude', 'initial_phase', 'phase')
+    _seekable = True
+
     def __init__(self, period, amplitude=1, initial_phase=0):
         self.period = period
         self.amplitude = amplitude
@@ -408,12 +828,19 @@ class Cos(Metric):
     
     def _calc(self, item):
         return self.amplitude * np.cos(item * (2 * np.pi) / self.period + self.initial_phase)
+
+    def _calc_block(self, item, n):
+        items = np.arange(item, item + n)
+        return self.amplitude * np.cos(items * (2 * np.pi) / self.period + self.initial_phase)
     
     def _reset(self):
         self.phase = self.initial_phase
 
 
 class Abs(Metric):
+    __slots__ = ('metric',)
+    _seekable = True
+
     def __init__(self, metric):
         self.metric = _x2m(metric)
         super().__init__()
@@ -423,30 +850,75 @@ class Abs(Metric):
     
     def _calc(self, item):
         return _max(self.metric.__next__(), 0)
+
+    def _calc_block(self, item, n):
+        return np.maximum(self.metric.next_block(n), 0)
     
     def _reset(self):
         self.metric.reset()
 
 
+class Cast(Metric):
+    __slots__ = ('metric', 'dtype')
+    _seekable = True
+
+    def __init__(self, metric, dtype):
+        self.metric = _x2m(metric)
+        self.dtype = np.dtype(dtype)
+        super().__init__()
+
+    def __repr__(self):
+        return f'<Cast({self.metric}, dtype={self.dtype})>'
+
+    def _calc(self, item):
+        return self.dtype.type(self.metric.__next__())
+
+    def _calc_block(self, item, n):
+        return self.metric.next_block(n).astype(self.dtype, copy=False)
+
+    def _reset(self):
+        self.metric.reset()
+
+
 class Acc(Metric):
-    def __init__(self, metric):
+    __slots__ = ('metric', 'dtype', 'value')
+    _state_attrs = ('value',)
+
+    def __init__(self, metric, dtype=None):
         self.metric = _x2m(metric)
-        self.value = 0
+        # an optional accumulator type, e.g. float64 over a float32 source
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.value = 0 if dtype is None else self.dtype.type(0)
         super().__init__()
     
     def __repr__(self):
         return f'<Acc({self.metric})>'
     
     def _calc(self, item):
-        self.value += self.metric.__next__()
+        if self.dtype is None:
+            self.value += self.metric.__next__()
+        else:
+            # cast like cumsum in the block path, every input and the sum are of the accumulator type
+            self.value = self.dtype.type(self.value + self.dtype.type(self.metric.__next__()))
         return self.value
+
+    def _calc_block(self, item, n):
+        values = self.metric.next_block(n)
+        initial = np.asarray([self.value], dtype=self.dtype or np.result_type(self.value, values))
+        values = np.cumsum(np.concatenate((initial, values)), dtype=self.dtype)[1:]
+        self.value = values[-1]
+        return values
     
     def _reset(self):
         self.metric.reset()
-        self.value = 0
+        self.value = 0 if self.dtype is None else self.dtype.type(0)
 
 
 class Diff(Metric):
+    __slots__ = ('metric', 'value')
+    _state_attrs = ('value',)
+    _seekable = True
+
     def __init__(self, metric):
         self.metric = _x2m(metric)
         self.value = np.nan
@@ -459,6 +931,19 @@ class Diff(Metric):
         old_value = self.value
         self.value = self.metric.__next__()
         return self.value - old_value
+
+    def _calc_block(self, item, n):
+        values = np.concatenate(([self.value], self.metric.next_block(n)))
+        self.value = values[-1]
+        return np.diff(values)
+
+    def _seek(self, item):
+        if item == 0:
+            self.metric._jump(0)
+            self.value = np.nan
+        else:
+            self.metric._jump(item - 1)
+            self.value = self.metric.__next__()
     
     def _reset(self):
         self.metric.reset()
@@ -466,13 +951,17 @@ class Diff(Metric):
 
 
 class Shift(Metric):
+    __slots__ = ('metric', 'n', 'n_left', 'skip', 'padding')
+    _state_attrs = ('n_left', 'skip')
+    _seekable = True
+
     def __init__(self, metric, n, padding=0):
         self.metric = _x2m(metric)
         self.n = n
         self.n_left = _max(0, n)
+        # a negative shift skips ahead on the first pull, the metric stays where it is until then
+        self.skip = _max(0, -n)
         self.padding = padding
-        for i in range(-n):
-            self.metric.__next__()
         super().__init__()
     
     def __repr__(self):
@@ -482,41 +971,144 @@ class Shift(Metric):
         if self.n_left > 0:
             self.n_left -= 1
             return self.padding
-        else:
-            return self.metric.__next__()
+        if self.skip:
+            self.metric._skip(self.skip)
+            self.skip = 0
+        return self.metric.__next__()
+
+    def _calc_block(self, item, n):
+        if self.skip:
+            self.metric._skip(self.skip)
+            self.skip = 0
+        n_padding = _min(self.n_left, n)
+        self.n_left -= n_padding
+        return np.concatenate((np.full(n_padding, self.padding), self.metric.next_block(n - n_padding)))
+
+    def _seek(self, item):
+        self.n_left = _max(0, self.n - item)
+        self.skip = 0
+        self.metric._jump(_max(0, item - self.n))
     
     def _reset(self):
         self.metric.reset()
-        self.n_left = self.n
+        self.n_left = _max(0, self.n)
+        self.skip = _max(0, -self.n)
 
 
 class Smooth(Metric):
+    __slots__ = ('metric', 'window_size', 'window_values', 'pos', 'sum', 'count', 'n_pos_inf', 'n_neg_inf',
+                 'since_sync')
+    _state_attrs = ('window_values', 'pos', 'sum', 'count', 'n_pos_inf', 'n_neg_inf', 'since_sync')
+    _seekable = True
+    sync_interval = 4096
+
     def __init__(self, metric, window_size):
         self.metric = _x2m(metric)
         self.window_size = window_size
-        self.window_values = [np.nan] * window_size
+        self.window_values = np.full(window_size, np.nan)
+        self.pos = 0
+        self.sum = 0
+        self.count = 0
+        self.n_pos_inf = 0
+        self.n_neg_inf = 0
+        self.since_sync = 0
         super().__init__()
     
     def __repr__(self):
         return f'<Smooth({self.metric}, window_size={self.window_size})'
     
     def _calc(self, item):
-        self.window_values.pop(0)
-        self.window_values.append(self.metric.__next__())
-        return np.nanmean(self.window_values)
+        value = self.metric.__next__()
+        self._count(self.window_values[self.pos], -1)
+        self._count(value, 1)
+        self.window_values[self.pos] = value
+        self.pos += 1
+        if self.pos == self.window_size:
+            self.pos = 0
+        self.since_sync += 1
+        if self.since_sync >= _max(self.window_size, self.sync_interval):
+            # re-sum now and then so the running sum cannot drift, at most once per lap
+            self._sync()
+        return self._mean()
+
+    def _calc_block(self, item, n):
+        w = self.window_size
+        values = np.concatenate((self.window_values[self.pos:], self.window_values[:self.pos],
+                                 self.metric.next_block(n)))
+        finite = np.isfinite(values)
+        sums = np.cumsum(np.where(finite, values, 0))
+        counts = np.cumsum(~np.isnan(values))
+        pos_inf = np.cumsum(values == np.inf)
+        neg_inf = np.cumsum(values == -np.inf)
+        sums, counts, pos_inf, neg_inf = (x[w:] - x[:-w] for x in (sums, counts, pos_inf, neg_inf))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = sums / counts
+        means[pos_inf > 0] = np.inf
+        means[neg_inf > 0] = -np.inf
+        means[(pos_inf > 0) & (neg_inf > 0)] = np.nan
+        self.window_values = values[-w:].copy()
+        self.pos = 0
+        self._sync()
+        return means
+
+    def _seek(self, item):
+        n_values = _min(item, self.window_size)
+        self.metric._jump(item - n_values)
+        self.window_values = np.concatenate((np.full(self.window_size - n_values, np.nan),
+                                             self.metric.next_block(n_values)))
+        self.pos = 0
+        self._sync()
+
+    def _count(self, value, sign):
+        if math.isfinite(value):
+            self.sum += sign * value
+            self.count += sign
+        elif value > 0:
+            self.n_pos_inf += sign
+            self.count += sign
+        elif value < 0:
+            self.n_neg_inf += sign
+            self.count += sign
+
+    def _sync(self):
+        finite = np.isfinite(self.window_values)
+        self.sum = self.window_values[finite].sum()
+        self.count = int((~np.isnan(self.window_values)).sum())
+        self.n_pos_inf = int((self.window_values == np.inf).sum())
+        self.n_neg_inf = int((self.window_values == -np.inf).sum())
+        self.since_sync = 0
+
+    def _mean(self):
+        if self.n_pos_inf and self.n_neg_inf:
+            return np.nan
+        elif self.n_pos_inf:
+            return np.inf
+        elif self.n_neg_inf:
+            return -np.inf
+        elif self.count == 0:
+            return np.nan
+        return self.sum / self.count
     
     def _reset(self):
-        self.window_values = [np.nan] * self.window_size
+        self.window_values = np.full(self.window_size, np.nan)
+        self.pos = 0
+        self._sync()
         self.metric.reset()
 
 
 class Regress(Metric):
+    __slots__ = ('metric', 'factors', 'window_size', 'paddings', 'window_values', 'pos')
+    _state_attrs = ('window_values', 'pos')
+    _seekable = True
+
     def __init__(self, metric, factors, paddings=None):
         self.metric = _x2m(metric)
-        self.factors = factors
+        self.factors = np.asarray(factors, dtype=float)
         self.window_size = len(factors)
         self.paddings = Const(0) if paddings is None else _x2m(paddings)
-        self.window_values = self.paddings.next(self.window_size)
+        # the window is stored twice in a row, so window_values[pos:pos + window_size] is always contiguous
+        self.window_values = np.tile(self.paddings.next_block(self.window_size).astype(float), 2)
+        self.pos = 0
         super().__init__()
     
     def __repr__(self):
@@ -527,23 +1119,40 @@ class Regress(Metric):
                 ')>')
     
     def _calc(self, item):
-        self.window_values.pop(0)
-        self.window_values.append(self.metric.__next__())
-        return sum(self.window_values[i] * self.factors[i] for i in range(self.window_size))
+        _push(self, self.metric.__next__())
+        return np.dot(self.window_values[self.pos:self.pos + self.window_size], self.factors)
+
+    def _calc_block(self, item, n):
+        values = np.concatenate((self.window_values[self.pos:self.pos + self.window_size],
+                                 self.metric.next_block(n)))
+        _fill(self, values[-self.window_size:])
+        return np.lib.stride_tricks.sliding_window_view(values, self.window_size)[1:] @ self.factors
+
+    def _seek(self, item):
+        n_values = _min(item, self.window_size)
+        self.paddings._jump(0)
+        paddings = self.paddings.next_block(self.window_size)
+        self.metric._jump(item - n_values)
+        _fill(self, np.concatenate((paddings[n_values:], self.metric.next_block(n_values))))
     
     def _reset(self):
         self.metric.reset()
         self.paddings.reset()
-        self.window_values = self.paddings.next(self.window_size)
+        self.window_values = np.tile(self.paddings.next_block(self.window_size).astype(float), 2)
+        self.pos = 0
 
 
 class AutoRegress(Metric):
+    __slots__ = ('metric', 'factors', 'window_size', 'initials', 'window_values', 'pos')
+    _state_attrs = ('initials', 'window_values', 'pos')
+
     def __init__(self, metric, factors):
         self.metric = _x2m(metric)
-        self.factors = factors
+        self.factors = np.asarray(factors, dtype=float)
         self.window_size = len(factors)
         self.initials = self.metric.next(self.window_size)
-        self.window_values = []
+        self.window_values = np.tile(np.asarray(self.initials, dtype=float), 2)
+        self.pos = 0
         super().__init__()
     
     def __repr__(self):
@@ -553,24 +1162,68 @@ class AutoRegress(Metric):
                 ')>')
     
     def _calc(self, item):
-        if len(self.window_values) < self.window_size:
-            value = self.initials[len(self.window_values)]
-        else:
-            value = sum(self.window_values[i] * self.factors[i] for i in range(self.window_size))
-            self.window_values.pop(0)
-        self.window_values.append(value)
+        if item < self.window_size:
+            return self.initials[item]
+        value = np.dot(self.window_values[self.pos:self.pos + self.window_size], self.factors)
+        _push(self, value)
         return value
+
+    def _calc_block(self, item, n):
+        w = self.window_size
+        n_initials = _max(0, _min(w - item, n))
+        values = np.empty(w + n - n_initials)
+        values[:w] = self.window_values[self.pos:self.pos + w]
+        for i in range(w, len(values)):
+            values[i] = np.dot(values[i - w:i], self.factors)
+        _fill(self, values[-w:])
+        return np.concatenate((self.initials[item:item + n_initials], values[w:]))
     
     def _reset(self):
         self.metric.reset()
         self.initials = self.metric.next(self.window_size)
-        self.window_values = []
+        self.window_values = np.tile(np.asarray(self.initials, dtype=float), 2)
+        self.pos = 0
+
+
+def _first(values):
+    valid = ~np.isnan(values)
+    value = values[np.arange(len(values)), valid.argmax(axis=1)]
+    return np.where(valid.any(axis=1), value, np.nan)
+
+
+def _last(values):
+    return _first(values[:, ::-1])
+
+
+_aggregations = {
+    'avg': lambda values: np.nanmean(values, axis=1),
+    'max': lambda values: np.nanmax(values, axis=1),
+    'min': lambda values: np.nanmin(values, axis=1),
+    'sum': lambda values: np.nansum(values, axis=1),
+    'count': lambda values: np.count_nonzero(~np.isnan(values), axis=1),
+    'first': _first,
+    'last': _last,
+    'std': lambda values: np.nanstd(values, axis=1),
+    'median': lambda values: np.nanmedian(values, axis=1),
+}
+
+
+def _aggregation(method):
+    if method in _aggregations:
+        return _aggregations[method]
+    percentile = re.fullmatch(r'p(\d+(?:\.\d+)?)', str(method))
+    if percentile is None or float(percentile.group(1)) > 100:
+        raise ValueError(f'invalid method "{method}"')
+    q = float(percentile.group(1))
+    return lambda values: np.nanpercentile(values, q, axis=1)
 
 
 class Downsample(Metric):
+    __slots__ = ('metric', 'sample_size', 'method')
+    _seekable = True
+
     def __init__(self, metric, sample_size, method='avg'):
-        if method not in ('avg', 'max', 'min'):
-            raise ValueError(f'invalid method "{method}"')
+        _aggregation(method)
         self.metric = _x2m(metric)
         self.sample_size = sample_size
         self.method = method
@@ -580,20 +1233,29 @@ class Downsample(Metric):
         return f'<Downsample({self.metric}, sample_size={self.sample_size}, method={self.method})>'
     
     def _calc(self, item):
-        samples = self.metric.next(self.sample_size)
-        if self.method == 'avg':
-            value = np.nanmean(samples)
-        elif self.method == 'max':
-            value = np.nanmax(samples)
-        elif self.method == 'min':
-            value = np.nanmin(samples)
-        return value
+        return self._calc_block(item, 1)[0]
+
+    def _calc_block(self, item, n):
+        # pull the source a chunk at a time however many samples each output takes
+        per_chunk = _max(1, _chunk_size // self.sample_size)
+        if n > per_chunk:
+            return np.concatenate([self._calc_block(item + i, _min(per_chunk, n - i)) for i in range(0, n, per_chunk)])
+        values = self.metric.next_block(n * self.sample_size)
+        if values.dtype.kind != 'f':
+            values = values.astype(float)
+        return _aggregation(self.method)(values.reshape(n, self.sample_size))
+    
+    def _seek(self, item):
+        self.metric._jump(item * self.sample_size)
     
     def _reset(self):
         self.metric.reset()
 
 
 class Repeat(Metric):
+    __slots__ = ('metric', 'start', 'end', 'n', 'period', 'exit', 'v')
+    _state_attrs = ('v',)
+
     def __init__(self, metric, start, end, n=None):
         self.metric = _x2m(metric)
         self.start = start
@@ -627,6 +1289,9 @@ class Repeat(Metric):
 
 
 class Cycle(Metric):
+    __slots__ = ('metric', 'start', 'end', 'n', 'period', 'exit', 'checkpoint')
+    _state_attrs = ('checkpoint',)
+
     def __init__(self, metric, start, end, n=None):
         self.metric = _x2m(metric)
         self.start = start
@@ -648,20 +1313,24 @@ class Cycle(Metric):
         if item < self.start or (self.exit is not None and item >= self.exit):
             value = self.metric.__next__()
         elif self.checkpoint is None:
-            self.checkpoint = deepcopy(self.metric)
+            self.checkpoint = self.metric.get_state()
             value = self.metric.__next__()
         elif (item - self.start) % self.period == 0:
-            self.metric.restore(self.checkpoint)
+            self.metric.set_state(self.checkpoint)
             value = self.metric.__next__()
         else:
             value = self.metric.__next__()
         return value
     
     def _reset(self):
+        self.checkpoint = None
         self.metric.reset()
 
 
 class Concat(Metric):
+    __slots__ = ('metric1', 'metric2', 'at')
+    _seekable = True
+
     def __init__(self, metric1, metric2, at=0):
         self.metric1 = _x2m(metric1)
         self.metric2 = _x2m(metric2)
@@ -676,13 +1345,88 @@ class Concat(Metric):
             return self.metric1.__next__()
         else:
             return self.metric2.__next__()
+
+    def _calc_block(self, item, n):
+        n1 = _min(_max(self.at - item, 0), n)
+        return np.concatenate((self.metric1.next_block(n1), self.metric2.next_block(n - n1)))
+
+    def _seek(self, item):
+        self.metric1._jump(_min(item, self.at))
+        self.metric2._jump(_max(0, item - self.at))
     
     def _reset(self):
         self.metric1.reset()
         self.metric2.reset()
 
 
+class _Breakpoints(Metric):
+    __slots__ = ('x', 'y')
+    _seekable = True
+
+    def __init__(self, points):
+        x, y = zip(*points)
+        # stable, so the last of several points at the same x wins
+        order = np.argsort(x, kind='stable')
+        self.x = np.asarray(x, dtype=float)[order]
+        self.y = np.asarray(y, dtype=float)[order]
+        super().__init__()
+
+    def __repr__(self):
+        return f'<{type(self).__name__}({_show_iterable_with_length_limit(list(zip(self.x.tolist(), self.y.tolist())), 4)}, len={len(self.x)})>'
+
+    def _seek(self, item):
+        pass
+
+    def _reset(self):
+        pass
+
+
+class Lines(_Breakpoints):
+    __slots__ = ()
+
+    def _calc(self, item):
+        k = int(self.x.searchsorted(item, side='right'))
+        if k == 0:
+            return self.y[0].item()
+        elif k == len(self.x):
+            return self.y[-1].item()
+        x0, x1, y0, y1 = self.x[k - 1].item(), self.x[k].item(), self.y[k - 1].item(), self.y[k].item()
+        return y0 + (y1 - y0) * (item - x0) / (x1 - x0)
+
+    def _calc_block(self, item, n):
+        t = np.arange(item, item + n, dtype=float)
+        # index of the last breakpoint at or before t, jumps take the later point
+        k = np.clip(np.searchsorted(self.x, t, side='right') - 1, 0, _max(len(self.x) - 2, 0))
+        if len(self.x) < 2:
+            return np.full(n, self.y[0])
+        x0, x1, y0, y1 = self.x[k], self.x[k + 1], self.y[k], self.y[k + 1]
+        # zero width segments come from jumps at the first or last breakpoint, they hold y0
+        width = x1 - x0
+        fraction = np.divide(np.clip(t, x0, x1) - x0, width, out=np.zeros(n), where=width > 0)
+        values = y0 + (y1 - y0) * fraction
+        return np.where(t >= self.x[-1], self.y[-1], values)
+
+
+class Steps(_Breakpoints):
+    __slots__ = ('initial',)
+
+    def __init__(self, points, initial=None):
+        super().__init__(points)
+        self.initial = self.y[0].item() if initial is None else initial
+
+    def _calc(self, item):
+        k = int(self.x.searchsorted(item, side='right'))
+        return self.y[k - 1].item() if k > 0 else self.initial
+
+    def _calc_block(self, item, n):
+        k = np.searchsorted(self.x, np.arange(item, item + n), side='right') - 1
+        return np.where(k >= 0, self.y[k], self.initial)
+
+
 class Add(Metric):
+    __slots__ = ('metric1', 'metric2')
+    _seekable = True
+
     def __init__(self, metric1, metric2):
         self.metric1 = _x2m(metric1)
         self.metric2 = _x2m(metric2)
@@ -693,6 +1437,9 @@ class Add(Metric):
     
     def _calc(self, item):
         return self.metric1.__next__() + self.metric2.__next__()
+
+    def _calc_block(self, item, n):
+        return self.metric1.next_block(n) + self.metric2.next_block(n)
     
     def _reset(self):
         self.metric1.reset()
@@ -700,6 +1447,9 @@ class Add(Metric):
 
 
 class Sub(Metric):
+    __slots__ = ('metric1', 'metric2')
+    _seekable = True
+
     def __init__(self, metric1, metric2):
         self.metric1 = _x2m(metric1)
         self.metric2 = _x2m(metric2)
@@ -710,6 +1460,9 @@ class Sub(Metric):
     
     def _calc(self, item):
         return self.metric1.__next__() - self.metric2.__next__()
+
+    def _calc_block(self, item, n):
+        return self.metric1.next_block(n) - self.metric2.next_block(n)
     
     def _reset(self):
         self.metric1.reset()
@@ -717,6 +1470,9 @@ class Sub(Metric):
 
 
 class Mul(Metric):
+    __slots__ = ('metric1', 'metric2')
+    _seekable = True
+
     def __init__(self, metric1, metric2):
         self.metric1 = _x2m(metric1)
         self.metric2 = _x2m(metric2)
@@ -727,6 +1483,9 @@ class Mul(Metric):
     
     def _calc(self, item):
         return self.metric1.__next__() * self.metric2.__next__()
+
+    def _calc_block(self, item, n):
+        return self.metric1.next_block(n) * self.metric2.next_block(n)
     
     def _reset(self):
         self.metric1.reset()
@@ -734,6 +1493,9 @@ class Mul(Metric):
 
 
 class Div(Metric):
+    __slots__ = ('metric1', 'metric2', 'floor')
+    _seekable = True
+
     def __init__(self, metric1, metric2, floor=False):
         self.metric1 = _x2m(metric1)
         self.metric2 = _x2m(metric2)
@@ -744,14 +1506,10 @@ class Div(Metric):
         return f'<{"Floor" if self.floor else ""}Div({self.metric1}, {self.metric2})>'
     
     def _calc(self, item):
-        v1 = self.metric1.__next__()
-        v2 = self.metric2.__next__()
-        if np.isnan(v2):
-            return np.nan
-        elif v2 == 0:
-            return np.inf
-        else:
-            return v1 // v2 if self.floor else v1 / v2
+        return _div(self.metric1.__next__(), self.metric2.__next__(), self.floor)
+
+    def _calc_block(self, item, n):
+        return _div_block(self.metric1.next_block(n), self.metric2.next_block(n), self.floor)
     
     def _reset(self):
         self.metric1.reset()
@@ -759,6 +1517,9 @@ class Div(Metric):
 
 
 class Mod(Metric):
+    __slots__ = ('metric1', 'metric2')
+    _seekable = True
+
     def __init__(self, metric1, metric2):
         self.metric1 = _x2m(metric1)
         self.metric2 = _x2m(metric2)
@@ -768,14 +1529,10 @@ class Mod(Metric):
         return f'<Mod({self.metric1}, {self.metric2})>'
     
     def _calc(self, item):
-        v1 = self.metric1.__next__()
-        v2 = self.metric2.__next__()
-        if np.isnan(v2):
-            return np.nan
-        elif v2 == 0:
-            return v1
-        else:
-            return v1 % v2
+        return _mod(self.metric1.__next__(), self.metric2.__next__())
+
+    def _calc_block(self, item, n):
+        return _mod_block(self.metric1.next_block(n), self.metric2.next_block(n))
     
     def _reset(self):
         self.metric1.reset()
@@ -783,6 +1540,9 @@ class Mod(Metric):
 
 
 class Pow(Metric):
+    __slots__ = ('metric1', 'metric2')
+    _seekable = True
+
     def __init__(self, metric1, metric2):
         self.metric1 = _x2m(metric1)
         self.metric2 = _x2m(metric2)
@@ -793,6 +1553,9 @@ class Pow(Metric):
     
     def _calc(self, item):
         return self.metric1.__next__() ** self.metric2.__next__()
+
+    def _calc_block(self, item, n):
+        return _pow_block(self.metric1.next_block(n), self.metric2.next_block(n))
     
     def _reset(self):
         self.metric1.reset()
@@ -800,17 +1563,60 @@ class Pow(Metric):
 
 
 class Pulse(Metric):
+    __slots__ = ('pos', 'val', 'p', 'v', 'positions', 'values', 'cursor', 'next_pos')
+    _state_attrs = ('p', 'v', 'cursor', 'next_pos')
+
     def __init__(self, pos, val):
-        self.pos = _x2m(pos)
-        self.val = _x2m(val)
-        self.p = self.pos.__next__()
-        self.v = self.val.__next__()
+        if isinstance(pos, (list, tuple, np.ndarray)) and not isinstance(val, Metric):
+            # positions known upfront are kept sparse: sorted, unique, integer and non-negative,
+            # values of duplicate positions add up, positions that can never fire are dropped
+            # a single value is used for every position, a sequence of values is padded with 0 like a fragment
+            positions = np.asarray(pos, dtype=float)
+            values = np.asarray(val, dtype=float)
+            if values.ndim == 0:
+                values = np.broadcast_to(values, positions.shape)
+            else:
+                values = np.concatenate((values[:len(positions)], np.zeros(_max(0, len(positions) - len(values)))))
+            fired = (positions >= 0) & (positions == np.floor(positions))
+            self.positions, inverse = np.unique(positions[fired].astype(np.int64), return_inverse=True)
+            self.values = np.bincount(inverse, weights=values[fired], minlength=len(self.positions))
+            self.pos = self.val = self.p = self.v = self.cursor = self.next_pos = None
+        else:
+            self.positions = self.values = self.cursor = self.next_pos = None
+            self.pos = _x2m(pos)
+            self.val = _x2m(val)
+            self.p = self.pos.__next__()
+            self.v = self.val.__next__()
         super().__init__()
     
     def __repr__(self):
+        if self.positions is not None:
+            return (f'<Pulse(pos={_show_iterable_with_length_limit(self.positions.tolist(), 4)}, '
+                    f'val={_show_iterable_with_length_limit(self.values.tolist(), 4)}, '
+                    f'len={len(self.positions)})>')
         return (f'<Pulse(pos={self.pos}, val={self.val})>')
+
+    @property
+    def seekable(self):
+        if self.positions is not None:
+            return True
+        # random access needs positions that are known upfront and fire one after another
+        if not isinstance(self.pos, Fragment) or not self.val.seekable:
+            return False
+        positions = np.asarray(self.pos.values)
+        return (len(positions) > 0 and positions[0] >= 0 and np.all(np.diff(positions) > 0)
+                and np.all(positions == np.floor(positions)))
     
     def _calc(self, item):
+        if self.positions is not None:
+            # cursor indexes the next position, looked up again only after a jump past it
+            if self.cursor is None or item > self.next_pos:
+                self._locate(int(self.positions.searchsorted(item)))
+            if item < self.next_pos:
+                return 0
+            value = self.values[self.cursor].item()
+            self._locate(self.cursor + 1)
+            return value
         if item == self.p:
             value = self.v
             self.p = self.pos.__next__()
@@ -818,8 +1624,40 @@ class Pulse(Metric):
         else:
             value = 0
         return value
+
+    def _calc_block(self, item, n):
+        values = np.zeros(n)
+        if self.positions is not None:
+            low, high = self.positions.searchsorted((item, item + n))
+            values[self.positions[low:high] - item] = self.values[low:high]
+            return values
+        start = item
+        end = item + n
+        while start <= self.p < end and self.p == int(self.p):
+            values[int(self.p) - item] = self.v
+            start = int(self.p) + 1
+            self.p = self.pos.__next__()
+            self.v = self.val.__next__()
+        return values
+
+    def _locate(self, k):
+        self.cursor = k
+        self.next_pos = self.positions[k].item() if k < len(self.positions) else math.inf
+
+    def _seek(self, item):
+        if self.positions is not None:
+            self.cursor = None
+            return
+        k = int(np.searchsorted(self.pos.values, item))
+        self.pos._jump(k)
+        self.val._jump(k)
+        self.p = self.pos.__next__()
+        self.v = self.val.__next__()
     
     def _reset(self):
+        if self.positions is not None:
+            self.cursor = None
+            return
         self.pos.reset()
         self.val.reset()
         self.p = self.pos.__next__()
@@ -827,6 +1665,9 @@ class Pulse(Metric):
 
 
 class Min(Metric):
+    __slots__ = ('metrics',)
+    _seekable = True
+
     def __init__(self, *args):
         self.metrics = [_x2m(x) for x in args]
         super().__init__()
@@ -836,12 +1677,18 @@ class Min(Metric):
     
     def _calc(self, item):
         return _min(metric.__next__() for metric in self.metrics)
+
+    def _calc_block(self, item, n):
+        return np.minimum.reduce([metric.next_block(n) for metric in self.metrics])
     
     def _reset(self):
         [metric.reset() for metric in self.metrics]
 
 
 class Max(Metric):
+    __slots__ = ('metrics',)
+    _seekable = True
+
     def __init__(self, *args):
         self.metrics = [_x2m(x) for x in args]
         super().__init__()
@@ -851,33 +1698,312 @@ class Max(Metric):
     
     def _calc(self, item):
         return _max(metric.__next__() for metric in self.metrics)
+
+    def _calc_block(self, item, n):
+        return np.maximum.reduce([metric.next_block(n) for metric in self.metrics])
     
     def _reset(self):
         [metric.reset() for metric in self.metrics]
 
 
+class Share(Metric):
+    __slots__ = ('metric', 'base', 'values', 'taps')
+    _state_attrs = ('base', 'values')
+    _seekable = True
+
+    def __init__(self, metric):
+        self.metric = _x2m(metric)
+        self.base = self.metric._i + 1
+        self.values = np.empty(0)
+        self.taps = weakref.WeakSet()
+        super().__init__()
+
+    def __repr__(self):
+        return f'<Share({self.metric})>'
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['taps'] = list(self.taps)
+        return state
+
+    def __setstate__(self, state):
+        state['taps'] = weakref.WeakSet(state['taps'])
+        super().__setstate__(state)
+
+    def tap(self):
+        return Tap(self)
+
+    def _calc(self, item):
+        return self._get(item, 1)[0]
+
+    def _calc_block(self, item, n):
+        return self._get(item, n)
+
+    def _get(self, item, n):
+        end = self.base + len(self.values)
+        if item < self.base or (item > end and self.metric.seekable):
+            self.metric.seek(item)
+            self.base = end = item
+            self.values = np.empty(0)
+        # values before the slowest consumer are never read again
+        cursors = [item] + [tap._i + 1 for tap in self.taps] + ([self._i + 1] if self._i >= 0 else [])
+        low = _max(self.base, _min(cursors))
+        if item + n > end:
+            self.values = np.concatenate((self.values[low - self.base:], self.metric.next_block(item + n - end)))
+            self.base = low
+        elif low > self.base:
+            self.values = self.values[low - self.base:]
+            self.base = low
+        return self.values[item - self.base:item + n - self.base].copy()
+
+    def _seek(self, item):
+        pass
+
+    def _reset(self):
+        self.metric.reset()
+        self.base = 0
+        self.values = np.empty(0)
+
+
+class Tap(Metric):
+    __slots__ = ('share',)
+    _seekable = True
+
+    def __init__(self, share):
+        self.share = share
+        share.taps.add(self)
+        super().__init__()
+
+    def __repr__(self):
+        return f'<Tap({self.share.metric})>'
+
+    def _calc(self, item):
+        return self.share._get(item, 1)[0]
+
+    def _calc_block(self, item, n):
+        return self.share._get(item, n)
+
+    def _seek(self, item):
+        pass
+
+    def _reset(self):
+        pass
+
+
+class Compiled(Metric):
+    __slots__ = ('metric', 'sources', 'constants', 'code', '_step', '_block')
+    _seekable = True
+
+    def __init__(self, metric):
+        # compiled from a copy, the nodes of the caller are never advanced or rewired
+        self._setup(metric._copy_tree())
+        # expressions below the other sources, e.g. the input of an Acc, get flat kernels of their own
+        kernels = [self]
+        compiled = {}
+        visited = set()
+        while kernels:
+            stack = list(kernels.pop().sources)
+
+            def compile_child(child):
+                if isinstance(child, Compiled):
+                    return child
+                elif type(child) not in _templates:
+                    stack.append(child)
+                    return child
+                elif id(child) not in compiled:
+                    compiled[id(child)] = Compiled.__new__(Compiled)
+                    compiled[id(child)]._setup(child)
+                    kernels.append(compiled[id(child)])
+                return compiled[id(child)]
+
+            while stack:
+                node = stack.pop()
+                if id(node) not in visited:
+                    visited.add(id(node))
+                    node._map_children(compile_child)
+
+    def __repr__(self):
+        return f'<Compiled(sources={_show_iterable_with_length_limit(self.sources, 4)}, len={len(self.sources)})>'
+
+    def __getstate__(self):
+        # only the tree is kept, the code is generated again on loading and never read from the state
+        state = super().__getstate__()
+        del state['sources'], state['constants'], state['code'], state['_step'], state['_block']
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._build()
+
+    def _setup(self, metric):
+        self.metric = metric
+        super().__init__()
+        self._i = metric._i
+        self._v = metric._v
+        self._build()
+
+    def _build(self):
+        self.sources = []
+        self.constants = []
+        self.code = _generate(self.metric, self.sources, self.constants)
+        namespace = dict(_compiled_namespace)
+        namespace.update((f'c{i}', c) for i, c in enumerate(self.constants))
+        namespace.update((f's{i}', s) for i, s in enumerate(self.sources))
+        exec(self.code, namespace)
+        self._step = namespace['_step']
+        self._block = namespace['_block']
+
+    def _calc(self, item):
+        return self._step(item)
+
+    def _calc_block(self, item, n):
+        return self._block(item, n)
+
+    def _map_children(self, func):
+        # the kernel holds the sources, it is built again for the new ones
+        super()._map_children(func)
+        self._build()
+
+    def _reset(self):
+        for source in self.sources:
+            source.reset()
+
+
+_elementwise_types = (Const, Fragment, _RandomMetric, Sin, Cos, Abs, Add, Sub, Mul, Div, Mod, Pow, Min, Max)
+_max_copied_nodes = 8
+_compiled_namespace = {
+    'np': np,
+    '_min': _min,
+    '_max': _max,
+    '_div': _div,
+    '_div_block': _div_block,
+    '_mod': _mod,
+    '_mod_block': _mod_block,
+    '_pow_block': _pow_block
+}
+
+
+def _is_small_elementwise(metric):
+    # larger subtrees are shared, evaluating them once per index outweighs the buffering
+    for i, node in enumerate(metric.walk()):
+        if i >= _max_copied_nodes or not isinstance(node, _elementwise_types):
+            return False
+    return True
+
+
+def _nested(func, args):
+    expr = args[0]
+    for arg in args[1:]:
+        expr = f'{func}({expr}, {arg})'
+    return expr
+
+
+_templates = {
+    Add: lambda node, args, block: f'{args[0]} + {args[1]}',
+    Sub: lambda node, args, block: f'{args[0]} - {args[1]}',
+    Mul: lambda node, args, block: f'{args[0]} * {args[1]}',
+    Div: lambda node, args, block: f'{"_div_block" if block else "_div"}({args[0]}, {args[1]}, {bool(node.floor)})',
+    Mod: lambda node, args, block: f'{"_mod_block" if block else "_mod"}({args[0]}, {args[1]})',
+    Pow: lambda node, args, block: f'_pow_block({args[0]}, {args[1]})' if block else f'{args[0]} ** {args[1]}',
+    Abs: lambda node, args, block: f'np.maximum({args[0]}, 0)' if block else f'_max({args[0]}, 0)',
+    Min: lambda node, args, block: _nested('np.minimum', args) if block else f'_min(({", ".join(args)},))',
+    Max: lambda node, args, block: _nested('np.maximum', args) if block else f'_max(({", ".join(args)},))'
+}
+_identities = {
+    Add: ((0, 0, 1), (1, 0, 0)),
+    Sub: ((1, 0, 0),),
+    Mul: ((0, 1, 1), (1, 1, 0)),
+    Pow: ((1, 1, 0),)
+}
+
+
+def _generate(metric, sources, constants):
+    # flatten the stateless, index-aligned part of the tree into straight-line code, other nodes become sources
+    names = {}
+    values = []
+    scalar_lines = []
+    block_lines = []
+    header = []
+
+    def constant(value):
+        constants.append(value)
+        return f'c{len(constants) - 1}'
+
+    def assign(scalar_expr, block_expr):
+        name = f'v{len(scalar_lines)}'
+        scalar_lines.append(f'    {name} = {scalar_expr}')
+        block_lines.append(f'    {name} = {block_expr}')
+        return name
+
+    # sources are pulled once per reference like in the interpreted tree, equal expressions are computed once
+    stack = [(metric, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if isinstance(node, Const):
+            values.append(constant(node.value))
+        elif isinstance(node, (Sin, Cos)):
+            key = (type(node), node.amplitude, node.period, node.initial_phase)
+            if key not in names:
+                func = 'np.sin' if isinstance(node, Sin) else 'np.cos'
+                header = ['    items = np.arange(item, item + n)']
+                args = [constant(v) for v in key[1:2] + (2 * np.pi,) + key[2:]]
+                names[key] = assign(f'{args[0]} * {func}(item * {args[1]} / {args[2]} + {args[3]})',
+                                    f'{args[0]} * {func}(items * {args[1]} / {args[2]} + {args[3]})')
+            values.append(names[key])
+        elif type(node) not in _templates:
+            sources.append(node)
+            values.append(assign(f's{len(sources) - 1}.__next__()', f's{len(sources) - 1}.next_block(n)'))
+        elif not expanded:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(list(node.children())))
+        else:
+            n_args = len(list(node.children()))
+            args = values[-n_args:]
+            del values[-n_args:]
+            template = _templates[type(node)]
+            key = (type(node), getattr(node, 'floor', None)) + tuple(args)
+            if all(arg.startswith('c') for arg in args):
+                namespace = dict(_compiled_namespace, **{f'c{i}': c for i, c in enumerate(constants)})
+                values.append(constant(eval(template(node, args, False), namespace)))
+                continue
+            for i, value, keep in _identities.get(type(node), ()):
+                if args[i].startswith('c') and type(constants[int(args[i][1:])]) is int \
+                        and constants[int(args[i][1:])] == value:
+                    values.append(args[keep])
+                    break
+            else:
+                if key not in names:
+                    names[key] = assign(template(node, args, False), template(node, args, True))
+                values.append(names[key])
+    result = values.pop()
+    block_result = f'np.full(n, {result})' if result.startswith('c') else result
+    return '\n'.join(['def _step(item):'] + scalar_lines + [f'    return {result}', '', '',
+                      'def _block(item, n):'] + header + block_lines +
+                     [f'    return {block_result}', ''])
+
+
 def const(value):
     return Const(value)
 
 
-def frag(values):
-    return Fragment(values)
+def frag(values, dtype=None):
+    return Fragment(values, dtype=dtype)
 
 
-def normal(scale=1, loc=0):
-    return Normal(scale, loc)
+def normal(scale=1, loc=0, seed=None, dtype=None):
+    return Normal(scale, loc, seed=seed, dtype=dtype)
 
 
-def rand(*args):
-    return Rand(*args)
+def rand(*args, seed=None, dtype=None):
+    return Rand(*args, seed=seed, dtype=dtype)
 
 
-def rand_int(*args):
-    return RandInt(*args)
+def rand_int(*args, seed=None, dtype=None):
+    return RandInt(*args, seed=seed, dtype=dtype)
 
 
-def rand_choice(choices, weights=None):
-    return RandChoice(choices, weights)
+def rand_choice(choices, weights=None, seed=None, dtype=None):
+    return RandChoice(choices, weights, seed=seed, dtype=dtype)
 
 
 def sin(period, amplitude=1, initial_phase=0):
@@ -888,8 +2014,12 @@ def cos(period, amplitude=1, initial_phase=0):
     return Cos(period, amplitude=amplitude, initial_phase=initial_phase)
 
 
-def acc(x):
-    return Acc(x)
+def acc(x, dtype=None):
+    return Acc(x, dtype=dtype)
+
+
+def astype(x, dtype):
+    return Cast(x, dtype)
 
 
 def diff(x):
@@ -913,6 +2043,10 @@ def autoregress(x, factors):
 
 
 def downsample(metric, sample_size, method='avg'):
+    if isinstance(method, (list, tuple)):
+        # one aggregation per method over a single pass of the shared source
+        source = share(metric)
+        return tuple(Downsample(source.tap(), sample_size, method=m) for m in method)
     return Downsample(metric, sample_size, method=method)
 
 
@@ -932,27 +2066,593 @@ def pulse(pos, val):
     return Pulse(pos, val)
 
 
+def share(metric):
+    return Share(metric)
+
+
 def rect(left, right, bottom, up):
-    return const(bottom).concat(left, const(up)).concat(right, const(bottom))
+    return Steps([(left, up), (right, bottom)], initial=bottom)
 
 
 def lines(points):
-    x, y = zip(*points)
-    m = const(y[0])
-    for i in range(len(x) - 1):
-        delta = (y[i + 1] - y[i]) / (x[i + 1] - x[i])
-        m = m.concat(x[i], y[i] + const(delta).acc() - delta)
-    return m.concat(x[-1], const(y[-1]))
+    return Lines(points)
+
+
+def steps(points, initial=None):
+    return Steps(points, initial=initial)
+
+
+class CompiledExpr:
+    def __init__(self, expr):
+        self.expr = expr
+        source = re.sub(r'#([0-9.]+(?![a-zA-Z])|\[[^\]]*\]|{[^}]*})', lambda x: f'_x2m({x.group(1)})', expr.strip())
+        self.metrics = tuple(dict.fromkeys(re.findall(r'\$([a-zA-Z_][a-zA-Z0-9_]*)', source)))
+        source = re.sub(r'\$(?=[a-zA-Z_])', _metric_prefix, source)
+        tree = ast.parse(source, mode='eval')
+        metric_names = {_metric_prefix + name for name in self.metrics}
+        for node in ast.walk(tree):
+            if not isinstance(node, _valid_nodes):
+                raise SyntaxError(f'invalid syntax: {type(node).__name__}')
+            elif isinstance(node, ast.Name):
+                name = node.id
+            elif isinstance(node, ast.Attribute):
+                name = node.attr
+            elif isinstance(node, ast.keyword):
+                name = node.arg
+            else:
+                continue
+            if name not in _valid_names and name not in metric_names:
+                raise SyntaxError(f'invalid name: {name}')
+        # sharing is only possible through repeated subexpressions or several metric references,
+        # other expressions skip dedup() on every call
+        n_refs = sum(isinstance(node, ast.Name) and node.id in metric_names for node in ast.walk(tree))
+        subexpressions = [ast.dump(node) for node in ast.walk(tree)
+                          if isinstance(node, (ast.Call, ast.BinOp, ast.UnaryOp))]
+        self.dedup = n_refs > 1 or len(set(subexpressions)) < len(subexpressions)
+        self.code = compile(tree, '<expr>', 'eval')
+
+    def __repr__(self):
+        return f'<CompiledExpr({self.expr!r})>'
+
+    def __call__(self, **metrics):
+        available_metrics = {}
+        for name in self.metrics:
+            metric = metrics.get(name)
+            if isinstance(metric, Metric):
+                # a copy, the caller's metric never advances
+                available_metrics[_metric_prefix + name] = metric._copy_tree()
+            elif callable(metric):
+                available_metrics[_metric_prefix + name] = metric()
+            else:
+                raise ValueError(f'metric {name} not found')
+        result = eval(self.code, globals(), available_metrics)
+        if isinstance(result, tuple) and all(isinstance(m, Metric) for m in result):
+            # downsample with several methods, the metrics already share their input
+            return result
+        return _x2m(result)._dedup() if self.dedup else _x2m(result)
+
+
+@lru_cache(maxsize=1024)
+def compile_expr(expr):
+    return CompiledExpr(expr)
 
 
 def parse(expr, **metrics):
-    expr = re.sub(r'#([0-9.]+(?![a-zA-Z])|\[[^\]]*\]|{[^}]*})', lambda x: f'_x2m({x.group(1)})', expr.strip())
-    for name in re.findall(r'(?<![\$a-zA-Z_])[a-zA-Z_]+[a-zA-Z0-9]*', expr):
-        if name not in _valid_names:
-            raise SyntaxError(f'invalid name: {name}')
-    available_metrics = {k: v for k, v in metrics.items() if isinstance(v, Metric)}
-    for name in re.findall(r'(?<=\$)[a-zA-Z_]+[a-zA-Z0-9]*', expr):
-        if name not in available_metrics:
-            raise ValueError(f'metric {name} not found')
-    expr = expr.replace('$', '')
-    return eval(expr, globals(), available_metrics)
+    return compile_expr(expr)(**metrics)
+
+
+def _rewind(metric):
+    # shares are only reset through themselves, their taps never reset them
+    metric.reset()
+    for node in metric.walk():
+        if isinstance(node, Share) and node is not metric:
+            node.reset()
+    return metric
+
+
+def _generate_rows(shm_name, shape, dtype, rows, chunk_size):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        values = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        for i, metric, seed in rows:
+            # every row is generated from its own copy starting at sample 0, in this process or in a worker
+            metric = parse(metric) if isinstance(metric, str) else _rewind(pickle.loads(pickle.dumps(metric)))
+            if seed is not None:
+                metric.seed(seed)
+            for start, chunk in zip(range(0, shape[1], chunk_size), metric.iter_chunks(chunk_size, shape[1])):
+                values[i, start:start + chunk_size] = chunk
+    finally:
+        shm.close()
+
+
+def generate_batch(metrics, length, seed=None, workers=None, chunk_size=65536, dtype=float):
+    metrics = list(metrics)
+    shape = (len(metrics), length)
+    dtype = np.dtype(dtype)
+    if seed is None:
+        seeds = [None] * len(metrics)
+    else:
+        # seeds follow the series, not the worker, so the result does not depend on the number of workers
+        seeds = (seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)).spawn(len(metrics))
+    rows = list(zip(range(len(metrics)), metrics, seeds))
+    shm = shared_memory.SharedMemory(create=True, size=_max(1, shape[0] * shape[1] * dtype.itemsize))
+    try:
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(rows) <= 1:
+            _generate_rows(shm.name, shape, dtype, rows, chunk_size)
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                n_tasks = workers * 4
+                futures = [pool.submit(_generate_rows, shm.name, shape, dtype, rows[i::n_tasks], chunk_size)
+                           for i in range(_min(n_tasks, len(rows)))]
+                for future in futures:
+                    future.result()
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _as_metrics(metrics):
+    if isinstance(metrics, (Metric, str)):
+        metrics = [metrics]
+    return [_x2m(parse(m) if isinstance(m, str) else m) for m in metrics]
+
+
+def _iter_chunks(metrics, length, chunk_size):
+    # time-major chunks of shape (samples, metrics)
+    start = 0
+    for chunks in zip(*(metric.iter_chunks(chunk_size, length) for metric in metrics)):
+        yield start, np.stack(chunks, axis=1)
+        start += len(chunks[0])
+
+
+@contextmanager
+def _open_output(file, mode):
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, mode) as f:
+            yield f
+    else:
+        yield file
+
+
+def _escape_line_protocol(name):
+    return re.sub(r'([ ,=\\])', r'\\\1', str(name))
+
+
+def _line_protocol(names, field, timestamps, values):
+    return [f'{name} {field}={v!r} {t}\n'
+            for t, row in zip(timestamps, values)
+            for name, v in zip(names, row) if not math.isnan(v)]
+
+
+def write_csv(file, metrics, length, names=None, chunk_size=65536, fmt='%.17g'):
+    metrics = _as_metrics(metrics)
+    names = [f'metric{i}' for i in range(len(metrics))] if names is None else names
+    with _open_output(file, 'w') as f:
+        f.write(','.join(['index'] + [str(name) for name in names]) + '\n')
+        for start, values in _iter_chunks(metrics, length, chunk_size):
+            index = np.arange(start, start + len(values))[:, None]
+            np.savetxt(f, np.hstack((index, values)), fmt=['%d'] + [fmt] * len(metrics), delimiter=',')
+
+
+def write_line_protocol(file, metrics, length, names=None, start=0, interval=10 ** 9, field='value',
+                        chunk_size=65536):
+    metrics = _as_metrics(metrics)
+    names = [f'metric{i}' for i in range(len(metrics))] if names is None else names
+    names = [_escape_line_protocol(name) for name in names]
+    field = _escape_line_protocol(field)
+    with _open_output(file, 'w') as f:
+        for offset, values in _iter_chunks(metrics, length, chunk_size):
+            timestamps = start + (offset + np.arange(len(values))) * interval
+            # line protocol has no NaN, missing samples are left out
+            f.writelines(_line_protocol(names, field, timestamps.tolist(), values.tolist()))
+
+
+def write_binary(file, metrics, length, dtype=None, chunk_size=65536):
+    metrics = _as_metrics(metrics)
+    with _open_output(file, 'wb') as f:
+        for _, values in _iter_chunks(metrics, length, chunk_size):
+            # the dtype of the generated values unless one is given, always little-endian
+            f.write(values.astype(np.dtype(dtype or values.dtype).newbyteorder('<'), copy=False).tobytes())
+
+
+def write_npy(file, metrics, length, dtype=None, chunk_size=65536):
+    metrics = _as_metrics(metrics)
+    values = None
+    for start, chunk in _iter_chunks(metrics, length, chunk_size):
+        if values is None:
+            values = np.lib.format.open_memmap(file, mode='w+', dtype=dtype or chunk.dtype, shape=(length, len(metrics)))
+        values[start:start + len(chunk)] = chunk
+    if values is None:
+        values = np.lib.format.open_memmap(file, mode='w+', dtype=dtype or float, shape=(length, len(metrics)))
+    values.flush()
+    return values
+
+
+class _Schedule:
+    def __init__(self, interval, prefetch):
+        self.interval = interval
+        self.prefetch = prefetch
+        self.names = []
+        self.metrics = []
+        self.values = np.empty((0, 0))
+        self.pos = 0
+        self.tick = 0
+
+    def fill(self):
+        if self.pos == self.values.shape[1]:
+            self.values = np.stack([metric.next_block(self.prefetch) for metric in self.metrics])
+            self.pos = 0
+
+    def take(self):
+        self.fill()
+        self.pos += 1
+        return self.values[:, self.pos - 1]
+
+
+class Emitter:
+    def __init__(self, sink, prefetch=64):
+        self.sink = sink
+        self.prefetch = prefetch
+        self.schedules = {}
+
+    def add(self, metric, interval=1.0, name=None):
+        schedule = self.schedules.setdefault(interval, _Schedule(interval, self.prefetch))
+        schedule.names.append(f'metric{sum(len(s.names) for s in self.schedules.values())}' if name is None else name)
+        schedule.metrics.append(_x2m(parse(metric) if isinstance(metric, str) else metric))
+        schedule.values = np.empty((0, 0))
+        schedule.pos = 0
+        return self
+
+    async def run(self, duration=None):
+        loop = asyncio.get_running_loop()
+        schedules = list(self.schedules.values())
+        for schedule in schedules:
+            schedule.fill()
+        start, wall = loop.time(), time.time()
+        end = math.inf if duration is None else start + duration
+        # deadlines are derived from the tick count, so sleeping late never accumulates drift
+        heap = [(start + s.tick * s.interval, i) for i, s in enumerate(schedules)]
+        heapq.heapify(heap)
+        while heap and heap[0][0] < end:
+            delay = heap[0][0] - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = loop.time()
+            # everything that is due goes out in one batch, including ticks missed while lagging behind
+            batch = []
+            while heap and heap[0][0] <= now and heap[0][0] < end:
+                deadline, i = heapq.heappop(heap)
+                schedule = schedules[i]
+                batch.append((wall + deadline - start, schedule.names, schedule.take()))
+                schedule.tick += 1
+                heapq.heappush(heap, (start + schedule.tick * schedule.interval, i))
+            await self._deliver(batch)
+        for schedule in schedules:
+            schedule.tick = 0
+
+    async def _deliver(self, batch):
+        if isinstance(self.sink, asyncio.Queue):
+            await self.sink.put(batch)
+        else:
+            result = self.sink(batch)
+            if inspect.isawaitable(result):
+                await result
+
+
+class SocketSink:
+    def __init__(self, path=None, host='127.0.0.1', port=None, field='value'):
+        self.path = path
+        self.host = host
+        self.port = port
+        self.field = _escape_line_protocol(field)
+        self.writer = None
+
+    async def __call__(self, batch):
+        if self.writer is None:
+            if self.path is not None:
+                _, self.writer = await asyncio.open_unix_connection(self.path)
+            else:
+                _, self.writer = await asyncio.open_connection(self.host, self.port)
+        for timestamp, names, values in batch:
+            names = [_escape_line_protocol(name) for name in names]
+            self.writer.writelines(line.encode() for line in _line_protocol(
+                names, self.field, [int(timestamp * 1e9)], [values.tolist()]))
+        await self.writer.drain()
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.writer = None
+
+
+class _NodeStats:
+    def __init__(self):
+        self.calls = 0
+        self.samples = 0
+        self.total = 0.
+        self.self = 0.
+        self.peak = 0
+
+
+class Profiler:
+    # nodes are switched to profiled subclasses while active, unprofiled trees run untouched code
+    def __init__(self, metric, memory=False):
+        self.metric = metric
+        self.memory = memory
+        self.stats = {}
+        self._classes = {}
+        self._originals = {}
+        self._stack = []
+        self._active = set()
+        self._tracing = False
+
+    def __enter__(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        for node in self.metric.walk():
+            self.stats.setdefault(id(node), _NodeStats())
+            self._originals[id(node)] = node, type(node)
+            node.__class__ = self._profiled(type(node))
+        return self
+
+    def __exit__(self, *exc):
+        for node, cls in self._originals.values():
+            node.__class__ = cls
+        self._originals.clear()
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def _profiled(self, cls):
+        if cls not in self._classes:
+            profiler = self
+
+            def _calc(node, item):
+                return profiler._call(node, 1, cls._calc, item)
+
+            def _calc_block(node, item, n):
+                return profiler._call(node, n, cls._calc_block, item, n)
+
+            namespace = {'__slots__': (), '__module__': cls.__module__, '_calc': _calc, '_calc_block': _calc_block}
+            if issubclass(cls, Share):
+                # taps read through _get, their time belongs to the share
+                def _get(node, item, n):
+                    return profiler._call(node, n, cls._get, item, n)
+
+                namespace['_get'] = _get
+            self._classes[cls] = type(cls.__name__, (cls,), namespace)
+        return self._classes[cls]
+
+    def _call(self, node, n, func, *args):
+        if id(node) in self._active:
+            # a node calling its own _calc or _calc_block is already counted by the outer call
+            return func(node, *args)
+        self._active.add(id(node))
+        stats = self.stats[id(node)]
+        if self.memory:
+            # the peak is reset for every call, callers keep the peak seen so far in their frame
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1][1] = _max(self._stack[-1][1], peak)
+            tracemalloc.reset_peak()
+        self._stack.append([0., 0])
+        start = time.perf_counter()
+        try:
+            return func(node, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._active.discard(id(node))
+            children_time, peak = self._stack.pop()
+            stats.calls += 1
+            stats.samples += n
+            stats.total += elapsed
+            stats.self += elapsed - children_time
+            if self._stack:
+                self._stack[-1][0] += elapsed
+            if self.memory:
+                peak = _max(peak, tracemalloc.get_traced_memory()[1])
+                stats.peak = _max(stats.peak, peak - current)
+                if self._stack:
+                    self._stack[-1][1] = _max(self._stack[-1][1], peak)
+
+    def report(self):
+        index = {id(node): i for i, node in enumerate(self.metric.walk())}
+        report = {}
+        reported = set()
+        stack = [(self.metric, report)]
+        while stack:
+            node, parent = stack.pop()
+            key = f'#{index[id(node)]} {type(node).__name__}'
+            if id(node) in reported:
+                # shared nodes are reported once, under their first parent
+                parent.setdefault(key, 'see above')
+                continue
+            reported.add(id(node))
+            stats = self.stats.get(id(node), _NodeStats())
+            result = {'calls': stats.calls,
+                      'samples': stats.samples,
+                      'total': f'{stats.total * 1e3:.3f} ms',
+                      'self': f'{stats.self * 1e3:.3f} ms'}
+            if self.memory:
+                result['peak'] = f'{stats.peak / 1024:.1f} KiB'
+            parent[key] = result
+            stack.extend((child, result) for child in reversed(list(node.children())))
+        return report
+
+    def show(self, **kwargs):
+        from enhanced_print import tree
+        return tree(self.report(), name='profile', **kwargs)
+
+
+_dump_magic = b'MGEN'
+_dump_version = 1
+
+
+class _Encoder:
+    def __init__(self, state, buffers=None):
+        self.state = state
+        self.buffers = buffers
+        self.offset = 0
+        self.ids = {}
+        self.nodes = []
+
+    def node(self, metric):
+        if id(metric) not in self.ids:
+            if globals().get(type(metric).__name__) is not type(metric):
+                raise TypeError(f'cannot serialize {type(metric).__name__}, only metric_generator nodes are supported')
+            self.ids[id(metric)] = len(self.nodes)
+            self.nodes.append(None)
+            fields = metric.__getstate__()
+            if not self.state:
+                for k in ('_i', '_v') + type(metric)._state_attrs:
+                    fields.pop(k, None)
+            # the entry is filled in after its fields, which may add further nodes
+            self.nodes[self.ids[id(metric)]] = [type(metric).__name__, {k: self.value(v) for k, v in fields.items()}]
+        return {'$n': self.ids[id(metric)]}
+
+    def value(self, value):
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        elif isinstance(value, Metric):
+            return self.node(value)
+        elif isinstance(value, np.ndarray):
+            if value.dtype.hasobject:
+                raise TypeError('cannot serialize arrays of objects')
+            data = np.ascontiguousarray(value).tobytes()
+            if self.buffers is None:
+                return {'$a': [value.dtype.str, value.shape, base64.b64encode(data).decode('ascii')]}
+            self.buffers.append(data)
+            self.offset += len(data)
+            return {'$a': [value.dtype.str, value.shape, self.offset - len(data), len(data)]}
+        elif isinstance(value, np.generic):
+            return {'$s': [value.dtype.str, value.item()]}
+        elif isinstance(value, np.dtype):
+            return {'$d': value.str}
+        elif isinstance(value, list):
+            return [self.value(v) for v in value]
+        elif isinstance(value, tuple):
+            return {'$t': [self.value(v) for v in value]}
+        elif isinstance(value, dict):
+            return {'$m': [[self.value(k), self.value(v)] for k, v in value.items()]}
+        raise TypeError(f'cannot serialize {type(value).__name__}')
+
+
+class _Decoder:
+    def __init__(self, entries, buffer=None):
+        self.buffer = buffer
+        self.nodes = []
+        for name, _ in entries:
+            cls = globals().get(name)
+            if not (isinstance(cls, type) and issubclass(cls, Metric)):
+                raise ValueError(f'unknown node type "{name}"')
+            self.nodes.append(cls.__new__(cls))
+
+    def value(self, value):
+        if isinstance(value, list):
+            return [self.value(v) for v in value]
+        elif not isinstance(value, dict):
+            return value
+        (tag, body), = value.items()
+        if tag == '$n':
+            return self.nodes[body]
+        elif tag == '$a':
+            dtype, shape = np.dtype(body[0]), tuple(body[1])
+            if self.buffer is None:
+                data = base64.b64decode(body[2])
+            else:
+                data = self.buffer[body[2]:body[2] + body[3]]
+            return np.frombuffer(data, dtype=dtype).reshape(shape).copy()
+        elif tag == '$s':
+            return np.dtype(body[0]).type(body[1])
+        elif tag == '$d':
+            return np.dtype(body)
+        elif tag == '$t':
+            return tuple(self.value(v) for v in body)
+        elif tag == '$m':
+            return {self.value(k): self.value(v) for k, v in body}
+        raise ValueError(f'invalid tag "{tag}"')
+
+    def order(self, entries):
+        # children before their parents, so that nodes building on their children see them complete
+        order = []
+        visited = set()
+        stack = [(0, False)]
+        while stack:
+            index, expanded = stack.pop()
+            if expanded:
+                order.append(index)
+            elif index not in visited:
+                visited.add(index)
+                stack.append((index, True))
+                stack.extend((child, False) for child in _node_refs(list(entries[index][1].values())))
+        return order
+
+
+def _node_refs(value):
+    if isinstance(value, list):
+        for v in value:
+            yield from _node_refs(v)
+    elif isinstance(value, dict):
+        (tag, body), = value.items()
+        if tag == '$n':
+            yield body
+        elif tag in ('$t', '$m'):
+            yield from _node_refs(body)
+
+
+def dumps(metric, state=False, binary=False):
+    metric = parse(metric) if isinstance(metric, str) else metric
+    buffers = [] if binary else None
+    encoder = _Encoder(state, buffers)
+    encoder.node(metric)
+    header = {'version': _dump_version, 'state': state, 'nodes': encoder.nodes}
+    if not binary:
+        return json.dumps(header, separators=(',', ':'))
+    header = json.dumps(header, separators=(',', ':')).encode()
+    # magic, version, header length, json header, then the raw array buffers
+    return b''.join([_dump_magic, struct.pack('<BI', _dump_version, len(header)), header] + buffers)
+
+
+def loads(data):
+    buffer = None
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data)
+        if data[:4] != _dump_magic:
+            raise ValueError('not a serialized metric')
+        version, length = struct.unpack_from('<BI', data, 4)
+        start = 4 + struct.calcsize('<BI')
+        header, buffer = data[start:start + length], memoryview(data)[start + length:]
+    else:
+        header = data
+    header = json.loads(header)
+    if header['version'] != _dump_version:
+        raise ValueError(f'unsupported version {header["version"]}')
+    decoder = _Decoder(header['nodes'], buffer)
+    for i in decoder.order(header['nodes']):
+        node = decoder.nodes[i]
+        fields = {k: decoder.value(v) for k, v in header['nodes'][i][1].items()}
+        if not header['state']:
+            fields.update((k, None) for k in ('_i', '_v') + type(node)._state_attrs if k not in fields)
+        node.__setstate__(fields)
+    root = decoder.nodes[0]
+    return root if header['state'] else _rewind(root)
+
+
+def dump(metric, file, state=False, binary=False):
+    with _open_output(file, 'wb' if binary else 'w') as f:
+        f.write(dumps(metric, state=state, binary=binary))
+
+
+def load(file):
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f:
+            data = f.read()
+    else:
+        data = file.read()
+    if isinstance(data, bytes) and not data.startswith(_dump_magic):
+        data = data.decode()
+    return loads(data)